@@ -14,26 +14,341 @@ import glob
 import json
 import re
 import time
+import stat
 import traceback
 import pprint
+import ast
+import importlib
+import weakref
+import collections
+import threading
+import logging
+from multiprocessing.pool import ThreadPool
 
 import plcr
 import rdlb
 import filterFiles
 
 #import apdr
-Action = plcr.Action
+
+_log = logging.getLogger(__name__)
+
+class CachedDatabase(object):
+    '''
+    A read through cache of the database for one engine run.
+    Results of the cachedMethods are kept by the method name and the
+    arguments, until they are older than ttl seconds or pushed out by
+    newer ones. The readMethods go to the database directly, they are
+    read again each time, like task status. Any other call may write,
+    it clears the cache.
+    '''
+    
+    cachedMethods = set(['find', 'getAssetId', 'getAssetIds', 'getPathFromTag',
+                         'getShotFrameRange', 'getShotLinkedAssets'])
+    readMethods = set(['doesVersionExist', 'doesVersionsExist', 'doesLatestVersionExist',
+                       'getTaskStatus', 'getUserTasks'])
+    
+    def __init__(self, database, ttl=300, maxSize=1024):
+        self._database = database
+        self.ttl = ttl
+        self._cache = _LRUCache(maxSize=maxSize)
+        self._lock = threading.Lock()
+        self._counts = {}
+        self.invalidations = 0
+    
+    def database(self):
+        '''Gets the real database.'''
+        return self._database
+    
+    def __deepcopy__(self, memo):
+        # Shared by the actions, like the database itself
+        return self
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        
+        attr = getattr(self._database, name)
+        if not callable(attr):
+            return attr
+        
+        if name in self.cachedMethods:
+            return lambda *args, **kwargs: self._read(name, attr, args, kwargs)
+        
+        if name in self.readMethods:
+            return attr
+        
+        return lambda *args, **kwargs: self._write(attr, args, kwargs)
+    
+    def _count(self, name, key):
+        with self._lock:
+            counts = self._counts.setdefault(name, {'hits': 0, 'misses': 0})
+            counts[key] += 1
+    
+    def _read(self, name, method, args, kwargs):
+        try:
+            key = json.dumps([name, args, kwargs], sort_keys=True, default=repr)
+        except (TypeError, ValueError):
+            self._count(name, 'misses')
+            return method(*args, **kwargs)
+        
+        cached = self._cache.get(key)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            self._count(name, 'hits')
+            return copy.deepcopy(cached[1])
+        
+        self._count(name, 'misses')
+        result = method(*args, **kwargs)
+        
+        # Keep a copy, the caller may change the result
+        try:
+            self._cache.set(key, (time.time(), copy.deepcopy(result)))
+        except Exception:
+            pass
+        return result
+    
+    def _write(self, method, args, kwargs):
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.invalidate()
+    
+    def invalidate(self):
+        '''Clears the cached results, the stats are kept.'''
+        self._cache.clear(resetStats=False)
+        with self._lock:
+            self.invalidations += 1
+    
+    def stats(self):
+        '''Gets the hits and misses of all methods and of each method.'''
+        with self._lock:
+            methods = copy.deepcopy(self._counts)
+            invalidations = self.invalidations
+        
+        hits = sum([c['hits'] for c in methods.values()])
+        misses = sum([c['misses'] for c in methods.values()])
+        total = hits + misses
+        
+        result = {
+            'size': len(self._cache),
+            'max_size': self._cache.maxSize,
+            'ttl': self.ttl,
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': float(hits) / total if total else 0.0,
+            'invalidations': invalidations,
+            'methods': methods
+        }
+        return result
+
+# Settings of the database cache, DatabaseCache action changes them for one engine,
+# it's off unless the template has the action
+_databaseCacheDefaults = {
+    'enabled': False,
+    'ttl': 300,
+    'max_size': 1024,
+}
+_databaseCacheLock = threading.Lock()
+
+def getCachedDatabase(engine, database):
+    '''
+    Gets the CachedDatabase of the database for the engine,
+    returns the database itself if the cache is disabled.
+    '''
+    if database is None:
+        return database
+    
+    settings = _sessionCache(engine, 'database_cache_settings')
+    if not settings:
+        settings.update(_databaseCacheDefaults)
+    if not settings['enabled']:
+        return database
+    
+    proxies = _sessionCache(engine, 'database_cache')
+    with _databaseCacheLock:
+        proxy = proxies.get(id(database))
+        if proxy is None or proxy.database() is not database:
+            proxy = CachedDatabase(database, ttl=settings['ttl'],
+                                   maxSize=settings['max_size'])
+            proxies[id(database)] = proxy
+    return proxy
+
+# Count of paths kept by the path info cache of each engine
+_pathInfoCacheSize = 4096
+_pathInfoCacheLock = threading.Lock()
+_missing = object()
+
+def _getPathInfoCache(engine):
+    caches = _sessionCache(engine, 'path_info')
+    with _pathInfoCacheLock:
+        cache = caches.get('cache')
+        if cache is None:
+            cache = _LRUCache(maxSize=_pathInfoCacheSize)
+            caches['cache'] = cache
+        return cache
+
+def getPathInfoCacheStats(engine):
+    '''Gets the size, hits, misses and hit_ratio of the path info cache of the engine.'''
+    return _getPathInfoCache(engine).stats()
+
+class Record(collections.Mapping):
+    '''
+    A mapping which can't be changed, for the task context passed
+    between the steps of an action. with_() and without() make a new
+    record on top of this one, only the changed keys are kept in it and
+    the others are read from this record, so a record is never copied.
+    After _maxDepth layers the items are put into one record again.
+    The values are shared, don't change them in place,
+    copy.deepcopy() copies them to a new record.
+    
+        task = Record({'shot': 'sc01_0010', 'step': 'ani', 'code': 'ani'})
+        info = task.without('code').with_(task=task['code'], version='latest')
+        info.copy()    # a dictionary which can be changed
+    '''
+    
+    _maxDepth = 8
+    
+    def __init__(self, items=None, **kwargs):
+        d = dict(items or {})
+        d.update(kwargs)
+        self._items = d
+        self._removed = frozenset()
+        self._parent = None
+        self._depth = 0
+        self._flat = d
+    
+    def _layer(self, items, removed):
+        if self._depth >= self._maxDepth:
+            d = self.copy()
+            for k in removed:
+                d.pop(k, None)
+            d.update(items)
+            return Record(d)
+        
+        r = Record()
+        r._items = items
+        r._removed = removed
+        r._parent = self
+        r._depth = self._depth + 1
+        r._flat = None
+        return r
+    
+    def _flatten(self):
+        if self._flat is None:
+            d = self._parent.copy()
+            for k in self._removed:
+                d.pop(k, None)
+            d.update(self._items)
+            self._flat = d
+        return self._flat
+    
+    def __getitem__(self, key):
+        r = self
+        while r is not None:
+            if key in r._items:
+                return r._items[key]
+            if key in r._removed:
+                break
+            r = r._parent
+        raise KeyError(key)
+    
+    def __iter__(self):
+        return iter(self._flatten())
+    
+    def __len__(self):
+        return len(self._flatten())
+    
+    def __setitem__(self, key, value):
+        raise TypeError('Record can not be changed, use with_() to make a new one')
+    
+    __delitem__ = __setitem__
+    
+    def __repr__(self):
+        return 'Record(%s)' % repr(self._flatten())
+    
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return Record(copy.deepcopy(self.copy(), memo))
+    
+    def __reduce__(self):
+        return (Record, (self.copy(),))
+    
+    def has_key(self, key):
+        return key in self
+    
+    def copy(self):
+        '''Gets the items as a dictionary which can be changed.'''
+        return dict(self._flatten())
+    
+    def with_(self, other=None, **kwargs):
+        '''Gets a new record with the items of other and kwargs set.'''
+        d = dict(other or {})
+        d.update(kwargs)
+        return self._layer(d, frozenset())
+    
+    def without(self, *keys):
+        '''Gets a new record without the keys.'''
+        return self._layer({}, frozenset(keys))
+
+class Action(plcr.Action):
+    '''
+    Base of the actions in this module,
+    database() returns the cached database of the engine.
+    '''
+    
+    def database(self):
+        return getCachedDatabase(self.engine(), plcr.Action.database(self))
+    
+    
+    def taskRecord(self):
+        '''Gets the task as a Record.'''
+        task = self.task()
+        if isinstance(task, Record):
+            return task
+        return Record(task or {})
+    
+    def getInfoFromPath(self, path):
+        '''
+        Gets the context info of the path from the engine. The results
+        are kept in an LRU cache shared by the actions of the engine,
+        the same reference paths are only resolved once in a scene.
+        '''
+        key = path.replace('\\', '/') if path else path
+        cache = _getPathInfoCache(self.engine())
+        info = cache.get(key, _missing)
+        if info is _missing:
+            info = self.engine().getInfoFromPath(path, enableCache=True)
+            cache.set(key, info)
+        
+        # A copy, the actions may change it
+        if type(info) == dict:
+            info = info.copy()
+        return info
 
 
 def makeFolder(path):
     folder = os.path.dirname(path)
     if not os.path.isdir(folder):
-        os.makedirs(folder)
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # The folder may be made by another thread at the same time
+            if not os.path.isdir(folder):
+                raise
 
 def copyFile(src, dst):
     src = src.replace('\\', '/')
     dst = dst.replace('\\', '/')
     if os.path.exists(src) and src != dst:
+        # The target may be a link into the texture store,
+        # remove it so we don't write into the shared file
+        if os.path.islink(dst):
+            os.remove(dst)
+        elif os.path.isfile(dst) and os.stat(dst).st_nlink > 1:
+            _removeFile(dst)
+        
         shutil.copyfile(src, dst)
 
 class IsSceneUntitled(Action):
@@ -91,12 +406,36 @@ class DoesVersionExisted(Action):
             return txt
 
 class DoesAnimationVersionExisted(Action):
+    '''
+    Checks whether the versions of the instances are published.
+    
+    With batch_query, if the database has doesVersionsExist, the
+    (part, asset) pairs are checked in one call:
+        database.doesVersionsExist(project, [filters1, filters2, ...])
+        return: [result1, result2, ...]
+    otherwise doesVersionExist is called for each pair.
+    '''
     
     _defaultParms = {
         'version': '{workfile_version}',
         'version_type': 'publish', 
+        'batch_query': True,
     }
     
+    def findExistingPairs(self, filters, pairs, batch=True):
+        '''Gets the (part, asset) pairs which have versions.'''
+        filtersList = []
+        for part,asset in pairs:
+            filtersList.append(filters + [['part', '=', part], ['asset', '=', asset]])
+        
+        database = self.database()
+        if batch and len(pairs) > 1 and hasattr(database, 'doesVersionsExist'):
+            results = database.doesVersionsExist(self.project(), filtersList)
+        else:
+            results = [database.doesVersionExist(self.project(), f) for f in filtersList]
+        
+        return [pair for pair,r in zip(pairs, results) if r]
+    
     def run(self):
         vn = self.parm('version')
         versionType = self.parm('version_type')
@@ -113,19 +452,19 @@ class DoesAnimationVersionExisted(Action):
             ['version', '=', vn]
         ]
         
+        pairs = []
+        for info in self.engine().getInputData():
+            pair = (info['instance'], info['asset'])
+            if pair not in pairs:
+                pairs.append(pair)
+        
+        batch = self.parm('batch_query')
+        existing = set(self.findExistingPairs(filters, pairs, batch=batch))
+        
         result = []
         for info in self.engine().getInputData():
             group = info['instance']
-            
-            theFilters = copy.deepcopy(filters)
-            theFilters.append(['part', '=', group])
-            theFilters.append(['asset', '=', info['asset']])
-            
-            #print 'filters:',theFilters
-            
-            r = self.database().doesVersionExist(self.project(), theFilters)
-            
-            if r:
+            if (group, info['asset']) in existing:
                 t = '    %s_%s' % (group, vn)
                 if t not in result:
                     result.append(t)
@@ -194,6 +533,8 @@ class NewScene(Action):
     progressText = 'Creating a new scene...'
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             try:
@@ -206,6 +547,8 @@ class OpenScene(Action):
     progressText = 'Opening a scene...'
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             path = self.parm('input')
@@ -220,6 +563,8 @@ class OpenScene(Action):
 class ImportScene(Action):
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             path = self.parm('input')
@@ -302,6 +647,8 @@ class ReferenceScene(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             info = self.parm('input')
@@ -332,6 +679,8 @@ class RemoveReference(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             refPath = self.parm('input')
@@ -346,6 +695,8 @@ class RemoveSceneObject(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             obj = self.parm('input')
@@ -363,6 +714,8 @@ class AssignMaterials(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             materials = self.parm('input')
@@ -393,7 +746,7 @@ class AssignMaterials(Action):
                 
                 return info
 
-class AssignMaterials2(plcr.Action):
+class AssignMaterials2(Action):
     
     _defaultParms = {
         'input': '',
@@ -403,6 +756,8 @@ class AssignMaterials2(plcr.Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             materials = self.parm('input')
@@ -507,6 +862,8 @@ class CreateCamera(Action):
     progressText = 'Creating camera from template...'
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             template = self.parm('template')
@@ -661,6 +1018,8 @@ class RenameChildren(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             path = self.parm('input')
@@ -682,6 +1041,8 @@ class GroupChildrenByNetworkBox(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             path = self.parm('input')
@@ -731,6 +1092,8 @@ class CreateSceneHierachy(Action):
     progressText = 'Creating scene hierachy...'
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             data = self.parm('hierachy')
@@ -842,119 +1205,107 @@ class SetSceneResolution(Action):
                 if len(res) == 2:
                     sw.setResolution(*res)
 
-class GetFpsFromDatabase(Action):
-    
-    progressText = 'get fps from database ...'
+_cgtwPath = r'C:\cgteamwork\bin\base'
+_cgtwLock = threading.Lock()
+_cgtwClient = None
+
+# Seconds the project settings are kept for an engine
+_projectSettingsTtl = 300
+
+def getCgtwClient():
+    '''
+    Gets the CGTeamwork client shared by all actions, it's created
+    at the first call. The module is cgtw by default, set the environment
+    variable CGTW_MODULE to use another module with the same interface,
+    like a local stand-in for working offline.
+    '''
+    global _cgtwClient
+    with _cgtwLock:
+        if _cgtwClient is None:
+            if _cgtwPath not in sys.path:
+                sys.path.append(_cgtwPath)
+            module = importlib.import_module(os.environ.get('CGTW_MODULE', 'cgtw'))
+            _cgtwClient = module.tw()
+        return _cgtwClient
+
+def _parseResolution(value):
+    '''Gets [width, height] of the resolution text like 1920×1080, [] if it's not valid.'''
+    if type(value) == unicode:
+        value = value.encode('utf-8')
+    if type(value) != str:
+        return []
     
-    def run(self):
-        import sys
-        sys.path.append(r'C:\cgteamwork\bin\base')
-        import cgtw
-        reload(cgtw)
-        
-        pro = self.task().get('project')
-        tw = cgtw.tw()
+    numbers = re.findall('\d+', value)
+    if len(numbers) != 2:
+        return []
+    return [int(i) for i in numbers]
+
+def getProjectSettings(engine, project, refresh=False):
+    '''
+    Gets the settings of the project from CGTeamwork in one query,
+    the result is cached for the engine for _projectSettingsTtl seconds:
+        {'fps': 25, 'width': 1920, 'height': 1080, 'resolution': [1920, 1080]}
+    width and height are None and resolution is [] if the resolution
+    of the project is not set.
+    '''
+    cache = _sessionCache(engine, 'project_settings')
+    cached = cache.get(project)
+    if not refresh and cached and time.time() - cached[0] < _projectSettingsTtl:
+        settings = cached[1]
+        return dict(settings, resolution=list(settings['resolution']))
+    
+    tw = getCgtwClient()
+    with _cgtwLock:
         t_info = tw.info_module('public', 'project')
         
-        filters = [['project.code', '=', pro]]
+        filters = [['project.code', '=', project]]
         t_info.init_with_filter(filters)
         
-        fields = ['project.frame_rate',
-                  #'project.resolution',
-                  ]
-        
+        fields = ['project.frame_rate', 'project.resolution']
         get = t_info.get(fields)
-        
-        fps = int(get[0]['project.frame_rate'])
-        
-        return fps
     
+    rsList = _parseResolution(get[0].get('project.resolution'))
+    
+    settings = {
+        'fps': int(get[0]['project.frame_rate']),
+        'width': rsList[0] if rsList else None,
+        'height': rsList[1] if rsList else None,
+        'resolution': rsList,
+    }
+    cache[project] = (time.time(), settings)
+    return dict(settings, resolution=list(rsList))
 
-
+class GetFpsFromDatabase(Action):
+    
+    progressText = 'get fps from database ...'
+    
+    def run(self):
+        pro = self.task().get('project')
+        return getProjectSettings(self.engine(), pro)['fps']
 
 class GetWidthFromDatabase(Action):
     
     progressText = 'get width of resolution from database ...'
     
     def run(self):
-        import sys
-        sys.path.append(r'C:\cgteamwork\bin\base')
-        import cgtw
-        reload(cgtw)
-        
         pro = self.task().get('project')
-        tw = cgtw.tw()
-        t_info = tw.info_module('public', 'project')
-        
-        filters = [['project.code', '=', pro]]
-        t_info.init_with_filter(filters)
-        
-        fields = [
-                  'project.resolution',
-                  ]
-        get = t_info.get(fields)
-
-        rs =  get[0]['project.resolution']
-        rs = rs.encode('utf-8')
-        #print "rs:",rs
-        rsList =  rs.split('×')
-        return int(rsList[0])
-
+        return getProjectSettings(self.engine(), pro)['width']
 
 class GetHeightFromDatabase(Action):
     
     progressText = 'get height of resolution from database ...'
+    
     def run(self):
-        import sys
-        sys.path.append(r'C:\cgteamwork\bin\base')
-        import cgtw
-        reload(cgtw)
-        
         pro = self.task().get('project')
-        tw = cgtw.tw()
-        t_info = tw.info_module('public', 'project')
-        
-        filters = [['project.code', '=', pro]]
-        t_info.init_with_filter(filters)
-        
-        fields = [
-                  'project.resolution',
-                  ]
-        get = t_info.get(fields)
+        return getProjectSettings(self.engine(), pro)['height']
 
-        rs =  get[0]['project.resolution']
-        rs = rs.encode('utf-8')
-        #print "rs:",rs
-        rsList =  rs.split('×')
-        return int(rsList[1])
-    
 class GetResolutionFromDatabase(Action):
     
     progressText = 'get width of resolution from database ...'
     
     def run(self):
-        import sys
-        sys.path.append(r'C:\cgteamwork\bin\base')
-        import cgtw
-        reload(cgtw)
-        
         pro = self.task().get('project')
-        tw = cgtw.tw()
-        t_info = tw.info_module('public', 'project')
-        
-        filters = [['project.code', '=', pro]]
-        t_info.init_with_filter(filters)
-        
-        fields = [
-                  'project.resolution',
-                  ]
-        get = t_info.get(fields)
-
-        rs =  get[0]['project.resolution']
-        rs = rs.encode('utf-8')
-        #print "rs:",rs
-        rsList =  rs.split('×')
-        return [int(rsList[0]),int(rsList[1])]
+        return list(getProjectSettings(self.engine(), pro)['resolution'])
 
 class SetSceneFps(Action):
     
@@ -1476,6 +1827,8 @@ class CreateRenderNode(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             path = self.parm('output')
@@ -1537,6 +1890,8 @@ class ReplaceReadNodesPaths(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             option = self.parm('option')
@@ -1559,6 +1914,8 @@ class ReplaceReadNodesPaths2(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
 
         first = self.task()['first_frame']
@@ -1597,6 +1954,8 @@ class RunExpression(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         ex = self.parm('expression')
         r = {}
         a = {}
@@ -1610,6 +1969,8 @@ class EvalString(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         ex = self.parm('input')
         ex = str(ex)
         return eval(ex)
@@ -1892,8 +2253,67 @@ class ReplaceString(Action):
         rePat = re.compile(fromS)
         return rePat.sub(toS, s)
 
+class _LRUCache(object):
+    '''
+    A thread safe dictionary keeping the latest used items,
+    the oldest item is removed when the size is over the max size.
+    '''
+    
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+            
+            self.misses += 1
+            return default
+    
+    def set(self, key, value):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            self._data[key] = value
+            while len(self._data) > self.maxSize:
+                self._data.popitem(last=False)
+    
+    def clear(self, resetStats=True):
+        with self._lock:
+            self._data.clear()
+            if resetStats:
+                self.hits = 0
+                self.misses = 0
+    
+    def stats(self):
+        total = self.hits + self.misses
+        if total:
+            ratio = float(self.hits) / total
+        else:
+            ratio = 0.0
+        
+        result = {
+            'size': len(self._data),
+            'max_size': self.maxSize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': ratio
+        }
+        return result
+
 _vnPattern = re.compile('([a-zA-Z]+)?(#+)')
-def parseVersionPattern(s):
+_versionPatternCache = _LRUCache(maxSize=1024)
+def _parseVersionPattern(s):
     result = _vnPattern.findall(s)
     if result:
         # s: tst_lgt_v###.ma
@@ -1916,15 +2336,25 @@ def parseVersionPattern(s):
     else:
         return s,s,'',''
 
-_digitsPattern = re.compile('([a-zA-Z]+)?(\d+)')
-def toVersionPattern(string):
+def parseVersionPattern(s):
     '''
-    Converts the string to a version pattern.
+    Parses the version pattern string, the result is cached
+    so each pattern is compiled only once.
     
     Example:
-        string: tst_lgt_v002.ma
-        return: tst_lgt_v###.ma
+        s: tst_lgt_v###.ma
+        return: (re pattern of tst_lgt_v(\d{3}).ma,
+                 tst_lgt_v%03d.ma, v###, v%03d)
     '''
+    key = ('parse', s)
+    result = _versionPatternCache.get(key)
+    if result == None:
+        result = _parseVersionPattern(s)
+        _versionPatternCache.set(key, result)
+    return result
+
+_digitsPattern = re.compile('([a-zA-Z]+)?(\d+)')
+def _toVersionPattern(string):
     result = _digitsPattern.findall(string)
     if result:
         # s: tst_lgt_v002.ma
@@ -1940,6 +2370,25 @@ def toVersionPattern(string):
         pattern = string.replace(digitsPat, vnPat)
         return pattern
 
+def toVersionPattern(string):
+    '''
+    Converts the string to a version pattern.
+    
+    Example:
+        string: tst_lgt_v002.ma
+        return: tst_lgt_v###.ma
+    '''
+    key = ('to', string)
+    result = _versionPatternCache.get(key, key)
+    if result is key:
+        result = _toVersionPattern(string)
+        _versionPatternCache.set(key, result)
+    return result
+
+def getVersionPatternCacheStats():
+    '''Gets hits and misses of the version pattern cache.'''
+    return _versionPatternCache.stats()
+
 def toVersionWildcard(string):
     '''
     Converts the string to a version wildcard pattern.
@@ -1963,29 +2412,11 @@ def toVersionWildcard(string):
         pattern = string.replace(digitsPat, vnPat)
         return pattern
 
-def getLatestVersion(files, filenamePattern):
+def _resolveVersionPattern(filenamePattern):
     '''
-    Gets latest version file of the files.
-    files is a list of string of filenames,
-    filenamePattern is a string for filtering the files.
-    
-    Example:
-        files:
-            tst_lgt_v001.ma
-            tst_lgt_v002.ma
-        filenamePattern:
-            tst_lgt_v###.ma or tst_lgt_v001.ma
-        return:
-            {version_pattern: v###
-             version_format: v%03d
-             file_format: tst_lgt_v%03d.ma
-             latest_version: v002
-             latest_version_number: 2
-             latest_file: tst_lgt_v002.ma
-             current_version: v003
-             current_version_number: 3
-             current_file: tst_lgt_v003.ma
-            }
+    Gets the parsed version pattern of filename pattern,
+    filenamePattern can be tst_lgt_v###.ma or tst_lgt_v001.ma.
+    Returns None if there's no version in the filename pattern.
     '''
     # Parse patterns
     # filenamePattern: tst_lgt_v###.ma
@@ -1994,32 +2425,25 @@ def getLatestVersion(files, filenamePattern):
     # versionPattern: v###
     # versionRePattern: v(\d{3})
     # versionFormat: v%03d
-    filenameRePattern,filenameFormat,versionPattern,versionFormat = parseVersionPattern(filenamePattern)
-    #print 'filenameRePattern:',filenameRePattern
-    #print 'filenameFormat:', filenameFormat
-    #print 'versionPattern:',versionPattern
-    #print 'versionFormat:', versionFormat
+    r = parseVersionPattern(filenamePattern)
+    filenameRePattern = r[0]
     
     if filenameRePattern == filenamePattern:
         # filenameRePattern: tst_lgt_v001.ma
         # filenameRePattern: tst_lgt_v###.ma
         filenamePattern = toVersionPattern(filenamePattern)
         if filenamePattern:
-            filenameRePattern,filenameFormat,versionPattern,versionFormat = parseVersionPattern(filenamePattern)
+            r = parseVersionPattern(filenamePattern)
         else:
             return
     
-    # Filter the files
-    okFiles = {}
-    for f in files:
-        r = filenameRePattern.findall(f)
-        #print 'r:',r
-        if r:
-            vn = int(r[0])
-            if not okFiles.has_key(vn):
-                okFiles[vn] = []
-            okFiles[vn].append(f)
-    
+    return (filenamePattern,) + r
+
+def _versionResult(okFiles, filenameFormat, versionPattern, versionFormat):
+    '''
+    Makes the result of getLatestVersion,
+    okFiles is a dictionary of version number and the files.
+    '''
     if okFiles:
         lastVersionNumber = sorted(okFiles.keys())[-1]
         latestVersion = versionFormat % lastVersionNumber
@@ -2045,38 +2469,209 @@ def getLatestVersion(files, filenamePattern):
     }
     return result
 
-class VersionUp(Action):
+def getLatestVersion(files, filenamePattern):
     '''
-    Folder structure of the work files:
-        001_01_model_v002.ma
-        versions:
-            001_01_model_v001.ma
-            001_01_model_v002.ma
-            001_01_model_v003.ma
+    Gets latest version file of the files.
+    files is a list of string of filenames,
+    filenamePattern is a string for filtering the files.
+    
+    Example:
+        files:
+            tst_lgt_v001.ma
+            tst_lgt_v002.ma
+        filenamePattern:
+            tst_lgt_v###.ma or tst_lgt_v001.ma
+        return:
+            {version_pattern: v###
+             version_format: v%03d
+             file_format: tst_lgt_v%03d.ma
+             latest_version: v002
+             latest_version_number: 2
+             latest_file: tst_lgt_v002.ma
+             current_version: v003
+             current_version_number: 3
+             current_file: tst_lgt_v003.ma
+            }
     '''
+    r = _resolveVersionPattern(filenamePattern)
+    if not r:
+        return
     
-    def run(self):
-        sw = self.software()
-        if sw:
-            # filename: 
-            path = self.parm('input')
-            #print 'action:',self.name
-            #print 'path:',[path]
-            folder = os.path.dirname(path)
-            filename = os.path.basename(path)
-            filename = filename.replace('_______', '_')
-            filename = filename.replace('______', '_')
-            filename = filename.replace('_____', '_')
-            filename = filename.replace('____', '_')
-            filename = filename.replace('___', '_')
-            filename = filename.replace('__', '_')
-            
-            if os.path.exists(folder):
-                files = os.listdir(folder)
-            else:
-                files = []
+    filenamePattern,filenameRePattern,filenameFormat,versionPattern,versionFormat = r
+    #print 'filenameRePattern:',filenameRePattern
+    #print 'filenameFormat:', filenameFormat
+    #print 'versionPattern:',versionPattern
+    #print 'versionFormat:', versionFormat
+    
+    # Filter the files
+    okFiles = {}
+    for f in files:
+        r = filenameRePattern.findall(f)
+        #print 'r:',r
+        if r:
+            vn = int(r[0])
+            if not okFiles.has_key(vn):
+                okFiles[vn] = []
+            okFiles[vn].append(f)
+    
+    return _versionResult(okFiles, filenameFormat, versionPattern, versionFormat)
+
+# Each publish folder may have an index file which keeps the latest
+# version of the version patterns, so we don't need to list the folder.
+# The index is used only when the folder is not changed since the index
+# was made. Only recordVersion writes the index, lookups never change
+# the folder. File systems keeping the modified time in seconds may not
+# change it when another version is written in the same second, so if
+# the folder was changed less than _versionIndexRacyTime seconds before
+# the index was made, the index is racy and we list the folder.
+_versionIndexFilename = '.version_index.json'
+_versionIndexRacyTime = 2.0
+
+def _readVersionIndex(folder):
+    path = '%s/%s' % (folder, _versionIndexFilename)
+    try:
+        f = open(path, 'r')
+        try:
+            index = json.loads(f.read())
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return {}
+    
+    if type(index) == dict and type(index.get('patterns')) == dict:
+        return index
+    return {}
+
+def _dumpVersionIndex(path, index):
+    try:
+        f = open(path, 'w')
+        try:
+            f.write(json.dumps(index))
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+def _writeVersionIndex(folder, index):
+    # Write the file in place, replacing the file changes modified time
+    # of the folder, it makes the index out of date.
+    # Making the file changes it too, so the folder is stat again and
+    # the new time is written, writing in place doesn't change it.
+    path = '%s/%s' % (folder, _versionIndexFilename)
+    created = not os.path.exists(path)
+    if not _dumpVersionIndex(path, index) or not created:
+        return
+    
+    try:
+        mtime = os.stat(folder).st_mtime
+    except OSError:
+        return
+    
+    if mtime != index.get('mtime'):
+        index['mtime'] = mtime
+        _dumpVersionIndex(path, index)
+
+def _isRacyVersionIndex(index):
+    mtime = index.get('mtime', 0)
+    if mtime != int(mtime):
+        # The file system keeps the time in less than a second,
+        # each change of the folder changes it
+        return False
+    return mtime >= index.get('checked', 0) - _versionIndexRacyTime
+
+def getLatestVersionInFolder(folder, filenamePattern, useIndex=True):
+    '''
+    Gets latest version file in the folder,
+    the result is the same as getLatestVersion.
+    
+    With useIndex, the latest version is read from the index file
+    of the folder if the folder is not changed and the index isn't racy,
+    otherwise we list the folder. The index is written by recordVersion.
+    '''
+    try:
+        mtime = os.stat(folder).st_mtime
+    except OSError:
+        return getLatestVersion([], filenamePattern)
+    
+    if not useIndex:
+        return getLatestVersion(os.listdir(folder), filenamePattern)
+    
+    resolved = _resolveVersionPattern(filenamePattern)
+    if not resolved:
+        return
+    
+    index = _readVersionIndex(folder)
+    entry = index.get('patterns', {}).get(resolved[0])
+    if entry and index.get('mtime') == mtime and not _isRacyVersionIndex(index):
+        vn,latestFile = entry
+        okFiles = {}
+        if vn:
+            okFiles[vn] = [latestFile]
+        filenameFormat,versionPattern,versionFormat = resolved[2:]
+        return _versionResult(okFiles, filenameFormat, versionPattern, versionFormat)
+    
+    return getLatestVersion(os.listdir(folder), filenamePattern)
+
+def recordVersion(folder, filenamePattern, versionNumber, filename):
+    '''
+    Updates the index file of the folder after a version file is written.
+    Other patterns in the index are dropped since we don't know whether
+    the folder is changed by others.
+    On file systems keeping the time in seconds the entry is racy,
+    the lookups list the folder instead of using it.
+    '''
+    resolved = _resolveVersionPattern(filenamePattern)
+    if not resolved:
+        return
+    
+    try:
+        mtime = os.stat(folder).st_mtime
+    except OSError:
+        return
+    
+    index = {
+        'mtime': mtime,
+        'checked': time.time(),
+        'patterns': {
+            resolved[0]: [versionNumber, filename]
+        }
+    }
+    _writeVersionIndex(folder, index)
+
+class VersionUp(Action):
+    '''
+    Folder structure of the work files:
+        001_01_model_v002.ma
+        versions:
+            001_01_model_v001.ma
+            001_01_model_v002.ma
+            001_01_model_v003.ma
+    '''
+    
+    _defaultParms = {
+        'input': '',
+        'use_version_index': True,
+    }
+    
+    def run(self):
+        sw = self.software()
+        if sw:
+            # filename: 
+            path = self.parm('input')
+            #print 'action:',self.name
+            #print 'path:',[path]
+            folder = os.path.dirname(path)
+            filename = os.path.basename(path)
+            filename = filename.replace('_______', '_')
+            filename = filename.replace('______', '_')
+            filename = filename.replace('_____', '_')
+            filename = filename.replace('____', '_')
+            filename = filename.replace('___', '_')
+            filename = filename.replace('__', '_')
             
-            r = getLatestVersion(files, filename)
+            useIndex = self.parm('use_version_index')
+            r = getLatestVersionInFolder(folder, filename, useIndex=useIndex)
             result = '%s/%s' % (folder, r['current_file'])
             return result
 
@@ -2085,18 +2680,15 @@ class GetAutoVersion(Action):
     _defaultParms = {       
         'input': '',
         'pattern': 'v###', 
+        'use_version_index': True,
     }
     
     def run(self):
         folder = self.parm('input')
         pattern = self.parm('pattern')
+        useIndex = self.parm('use_version_index')
         
-        if os.path.exists(folder):
-            files = os.listdir(folder)
-        else:
-            files = []
-        
-        r = getLatestVersion(files, pattern)
+        r = getLatestVersionInFolder(folder, pattern, useIndex=useIndex)
         
         return r['current_version']
 
@@ -2316,10 +2908,238 @@ class RemoveFiles(Action):
             elif os.path.isdir(f):
                 shutil.rmtree(f)
 
+class _Absent(object):
+    '''Value of a cell which the row doesn't have, it's never copied.'''
+    
+    def __repr__(self):
+        return '<absent>'
+    
+    def __copy__(self):
+        return self
+    
+    def __deepcopy__(self, memo):
+        return self
+    
+    def __reduce__(self):
+        return '_absent'
+
+_absent = _Absent()
+
+class Table(object):
+    '''
+    A table keeping the rows by columns, each column is a list.
+    Iterating a table gives the rows as dictionaries, so the actions
+    taking a list of dictionaries can take a table too.
+    Hash indexes of the columns are made at the first filtering
+    by the column and reused by the later filters.
+    
+        table = Table.fromRows([{'asset': 'dog', 'step': 'rig'}, ...])
+        table.filter({'asset': ['dog', 'cat'], 'step': 'rig'})
+        table.groupBy('asset')
+        table.select(['asset']).toRows()
+    '''
+    
+    def __init__(self, columns=None, length=0):
+        if columns is None:
+            columns = collections.OrderedDict()
+        self._columns = columns
+        self._length = length
+        self._indexes = {}
+    
+    @classmethod
+    def fromRows(cls, rows):
+        '''Makes a table of a list of dictionaries, a table is returned as it is.'''
+        if isinstance(rows, Table):
+            return rows
+        
+        if not rows:
+            rows = []
+        
+        columns = collections.OrderedDict()
+        for i,row in enumerate(rows):
+            for k in row.keys():
+                if not columns.has_key(k):
+                    columns[k] = [_absent] * i
+            for k,column in columns.items():
+                column.append(row.get(k, _absent))
+        
+        return cls(columns, len(rows))
+    
+    @classmethod
+    def concat(cls, tables):
+        '''Joins the rows of the tables or lists of dictionaries.'''
+        tables = [cls.fromRows(t) for t in tables]
+        length = sum([len(t) for t in tables])
+        
+        columns = collections.OrderedDict()
+        for t in tables:
+            for k in t._columns.keys():
+                if not columns.has_key(k):
+                    columns[k] = []
+        
+        for k,column in columns.items():
+            for t in tables:
+                column.extend(t._columns.get(k, [_absent] * len(t)))
+        
+        return cls(columns, length)
+    
+    def __len__(self):
+        return self._length
+    
+    def __iter__(self):
+        for i in xrange(self._length):
+            yield self.row(i)
+    
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.take(range(*i.indices(self._length)))
+        
+        if i < 0:
+            i += self._length
+        if i < 0 or i >= self._length:
+            raise IndexError('table index out of range')
+        return self.row(i)
+    
+    def __repr__(self):
+        return '<Table %s rows: %s>' % (self._length, ', '.join(self._columns.keys()))
+    
+    def row(self, i):
+        '''Gets the row as a new dictionary.'''
+        result = {}
+        for k,column in self._columns.iteritems():
+            v = column[i]
+            if v is not _absent:
+                result[k] = v
+        return result
+    
+    def toRows(self):
+        return [self.row(i) for i in xrange(self._length)]
+    
+    def keys(self):
+        return self._columns.keys()
+    
+    def column(self, name):
+        '''Gets the values of the column, None if a row doesn't have it.'''
+        column = self._columns.get(name)
+        if column is None:
+            return [None] * self._length
+        return [None if v is _absent else v for v in column]
+    
+    def index(self, name):
+        '''
+        Gets the hash index of the column: {value: [row positions]},
+        None if the column has values which can't be hashed.
+        '''
+        if self._indexes.has_key(name):
+            return self._indexes[name]
+        
+        index = {}
+        try:
+            for i,v in enumerate(self.column(name)):
+                if index.has_key(v):
+                    index[v].append(i)
+                else:
+                    index[v] = [i]
+        except TypeError:
+            index = None
+        
+        self._indexes[name] = index
+        return index
+    
+    def take(self, positions):
+        '''Gets a new table of the rows at the positions.'''
+        columns = collections.OrderedDict()
+        for k,column in self._columns.iteritems():
+            columns[k] = [column[i] for i in positions]
+        return Table(columns, len(positions))
+    
+    def matches(self, filters):
+        '''
+        Gets the positions of the rows matching all filters,
+        a filter is a value or a list of values of the column:
+            {'asset': ['dog', 'cat'], 'step': 'rig'}
+        '''
+        positions = None
+        for k,value in filters.items():
+            values = value if type(value) == list else [value]
+            index = self.index(k)
+            
+            found = set()
+            try:
+                if index is None:
+                    raise TypeError
+                for v in values:
+                    found.update(index.get(v, ()))
+            
+            # Can't look up by hash, compare the values one by one
+            except TypeError:
+                column = self.column(k)
+                for i in xrange(self._length):
+                    if column[i] in values:
+                        found.add(i)
+            
+            if positions is None:
+                positions = found
+            else:
+                positions &= found
+            
+            if not positions:
+                return []
+        
+        if positions is None:
+            return range(self._length)
+        return sorted(positions)
+    
+    def filter(self, filters):
+        '''Gets a new table of the rows matching the filters, see matches.'''
+        return self.take(self.matches(filters))
+    
+    def select(self, names):
+        '''Gets a new table with only the columns.'''
+        columns = collections.OrderedDict()
+        for k in names:
+            columns[k] = list(self._columns.get(k, [_absent] * self._length))
+        return Table(columns, self._length)
+    
+    def groupBy(self, name):
+        '''Gets the tables of the values of the column in the order they appear.'''
+        groups = collections.OrderedDict()
+        for i,v in enumerate(self.column(name)):
+            key = v
+            try:
+                hash(key)
+            except TypeError:
+                key = repr(v)
+            if not groups.has_key(key):
+                groups[key] = (v, [])
+            groups[key][1].append(i)
+        
+        result = collections.OrderedDict()
+        for key,(v,positions) in groups.items():
+            result[key] = self.take(positions)
+        return result
+
+def _tableOutput(action, data, inputIsTable):
+    '''
+    Gets the output of the table actions by the as_table parm:
+    True for a Table, False for a list of dictionaries,
+    None for the same type as the input.
+    '''
+    asTable = action.parm('as_table')
+    if asTable is None:
+        asTable = inputIsTable
+    
+    if asTable:
+        return Table.fromRows(data)
+    elif isinstance(data, Table):
+        return data.toRows()
+    return data
+
 class CombineData(Action):
     
     _defaultParms = {
         'inputs': [],
+        'as_table': None,
     }
     
     def run(self):
@@ -2327,11 +3147,19 @@ class CombineData(Action):
         if not inputs:
             inputs = []
         
-        result = []
+        isTable = False
         for i in inputs:
-            result += i
+            if isinstance(i, Table):
+                isTable = True
         
-        return result
+        if isTable:
+            result = Table.concat(inputs)
+        else:
+            result = []
+            for i in inputs:
+                result.extend(i)
+        
+        return _tableOutput(self, result, isTable)
 
 '''
 groupKey = 'namespace'
@@ -2363,7 +3191,8 @@ class GroupData(Action):
         'group_key': '',
         'collapse_key': '',
         'new_key': '',
-        'data': []
+        'data': [],
+        'as_table': None,
     }
     
     def run(self):
@@ -2372,6 +3201,16 @@ class GroupData(Action):
         newKey = self.parm('new_key')
         data = self.parm('data')
         
+        if isinstance(data, Table):
+            result = []
+            for table in data.groupBy(groupKey).values():
+                d = table.row(0)
+                values = table.column(newKeySource)
+                d.pop(newKeySource, None)
+                d[newKey] = values
+                result.append(d)
+            return _tableOutput(self, result, True)
+        
         groups = []
         temp = {}
         for d in data:
@@ -2381,6 +3220,7 @@ class GroupData(Action):
                 groups.append(d)
             temp[group].append(d)
         
+        # New rows, the input rows may be used by other actions
         result = []
         for d in groups:
             group = d.get(groupKey)
@@ -2389,17 +3229,23 @@ class GroupData(Action):
             for info in temp[group]:
                 lst.append(info.get(newKeySource))
             
+            d = dict(d)
+            d.pop(newKeySource, None)
             d[newKey] = lst
-            del d[newKeySource]
             
             result.append(d)
         
-        return result
+        return _tableOutput(self, result, False)
 
 class DataTable(Action):
+    '''
+    Gets the input data, set as_table to True to pass it
+    as a Table to the following table actions.
+    '''
     
     _defaultParms = {
         'input': [],
+        'as_table': None,
     }
     
     #def __init__(self, engine):
@@ -2411,35 +3257,300 @@ class DataTable(Action):
     #    self._items.append(item)
     
     def run(self):
-        return self.parm('input')
+        data = self.parm('input')
+        return _tableOutput(self, data, isinstance(data, Table))
+
+_whereToken = re.compile(r'''
+    \s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")|
+        (?P<number>-?\d+(?:\.\d+)?)|
+        (?P<op>==|!=|<=|>=|=~|!~|<|>|=|\(|\)|\[|\]|,)|
+        (?P<name>[a-zA-Z_][a-zA-Z0-9_\.]*)
+    )''', re.VERBOSE)
+_whereConstants = {'True': True, 'False': False, 'None': None}
+
+def _whereKind(value):
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, (int, long, float)):
+        return 'number'
+    if isinstance(value, basestring):
+        return 'string'
+    return type(value)
+
+def _whereOrdered(compare):
+    '''
+    Makes an ordering compare False when a value is None or the types
+    don't match, Python 2 orders any values, like None < 100 and 'a' >= 100.
+    '''
+    def func(a, b):
+        if a is None or b is None or _whereKind(a) != _whereKind(b):
+            return False
+        return compare(a, b)
+    return func
+
+_whereCompares = {
+    '==': lambda a, b: a == b,
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': _whereOrdered(lambda a, b: a < b),
+    '<=': _whereOrdered(lambda a, b: a <= b),
+    '>': _whereOrdered(lambda a, b: a > b),
+    '>=': _whereOrdered(lambda a, b: a >= b),
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+}
+
+class _WhereParser(object):
+    '''
+    Parses the expression of FilterDataTable where parm to a function
+    of a row. The grammar:
+        expr: and_expr ('or' and_expr)*
+        and_expr: not_expr ('and' not_expr)*
+        not_expr: 'not' not_expr | compare
+        compare: operand (op operand)?
+        op: == = != < <= > >= =~ !~ in, not in
+        operand: key | 'string' | number | [list] | True | False | None | (expr)
+    '''
+    
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = []
+        pos = 0
+        expression = expression.rstrip()
+        while pos < len(expression):
+            m = _whereToken.match(expression, pos)
+            if not m:
+                # Skip the spaces before the character
+                rest = expression[pos:]
+                pos += len(rest) - len(rest.lstrip())
+                self.error('unknown character "%s" at %s' % (expression[pos], pos))
+            kind = m.lastgroup
+            self.tokens.append((kind, m.group(kind)))
+            pos = m.end()
+        self.pos = 0
+    
+    def error(self, message):
+        raise ValueError('Invalid where expression "%s": %s' % (self.expression, message))
+    
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+    
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+    
+    def accept(self, value):
+        kind,v = self.peek()
+        if kind in ('op', 'name') and v == value:
+            self.pos += 1
+            return True
+        return False
+    
+    def expect(self, value):
+        if not self.accept(value):
+            self.error('expect "%s"' % value)
+    
+    def parse(self):
+        func = self.parseOr()
+        if self.pos < len(self.tokens):
+            self.error('unexpected "%s"' % self.peek()[1])
+        return func
+    
+    def parseOr(self):
+        funcs = [self.parseAnd()]
+        while self.accept('or'):
+            funcs.append(self.parseAnd())
+        if len(funcs) == 1:
+            return funcs[0]
+        return lambda row: any(f(row) for f in funcs)
+    
+    def parseAnd(self):
+        funcs = [self.parseNot()]
+        while self.accept('and'):
+            funcs.append(self.parseNot())
+        if len(funcs) == 1:
+            return funcs[0]
+        return lambda row: all(f(row) for f in funcs)
+    
+    def parseNot(self):
+        if self.accept('not'):
+            func = self.parseNot()
+            return lambda row: not func(row)
+        return self.parseCompare()
+    
+    def parseCompare(self):
+        left = self.parseOperand()
+        kind,v = self.peek()
+        
+        op = None
+        if kind == 'op' and v in ('==', '=', '!=', '<', '<=', '>', '>=', '=~', '!~'):
+            op = v
+            self.pos += 1
+        elif self.accept('in'):
+            op = 'in'
+        elif kind == 'name' and v == 'not' and self.tokens[self.pos+1:self.pos+2] == [('name', 'in')]:
+            op = 'not in'
+            self.pos += 2
+        
+        if op is None:
+            return lambda row: bool(left(row))
+        
+        if op in ('=~', '!~'):
+            kind,pattern = self.next()
+            if kind != 'string':
+                self.error('%s needs a string pattern' % op)
+            pat = re.compile(self.literal(pattern))
+            found = op == '=~'
+            def regex(row):
+                value = left(row)
+                if value is None:
+                    return not found
+                if type(value) not in (str, unicode):
+                    value = str(value)
+                return bool(pat.search(value)) == found
+            return regex
+        
+        right = self.parseOperand()
+        compare = _whereCompares[op]
+        def check(row):
+            try:
+                return compare(left(row), right(row))
+            except TypeError:
+                return False
+        return check
+    
+    def literal(self, token):
+        if type(self.expression) == unicode:
+            return ast.literal_eval('u' + token)
+        return ast.literal_eval(token)
+    
+    def parseOperand(self):
+        kind,v = self.next()
+        if kind == 'string':
+            value = self.literal(v)
+            return lambda row: value
+        
+        if kind == 'number':
+            value = ast.literal_eval(str(v))
+            return lambda row: value
+        
+        if kind == 'op' and v == '(':
+            func = self.parseOr()
+            self.expect(')')
+            return func
+        
+        if kind == 'op' and v == '[':
+            items = []
+            if not self.accept(']'):
+                items.append(self.parseOperand())
+                while self.accept(','):
+                    items.append(self.parseOperand())
+                self.expect(']')
+            return lambda row: [f(row) for f in items]
+        
+        if kind == 'name' and v not in ('and', 'or', 'not', 'in'):
+            if _whereConstants.has_key(v):
+                value = _whereConstants[v]
+                return lambda row: value
+            return lambda row: row.get(v)
+        
+        self.error('unexpected "%s"' % v)
+
+_whereCache = _LRUCache(maxSize=256)
+def compileWhere(expression):
+    '''
+    Compiles the where expression to a function of a row,
+    which returns True if the row matches. Compiled functions
+    are cached by the expression:
+        match = compileWhere("step in ['rig', 'mod'] and not asset =~ '^tmp_'")
+        match({'step': 'rig', 'asset': 'dog'})
+    '''
+    func = _whereCache.get(expression)
+    if func is None:
+        func = _WhereParser(expression).parse()
+        _whereCache.set(expression, func)
+    return func
+
+class _RowView(object):
+    '''Reads a row of the Table without making a dictionary.'''
+    
+    def __init__(self, columns):
+        self._columns = columns
+        self.i = 0
+    
+    def get(self, key, default=None):
+        column = self._columns.get(key)
+        if column is None:
+            return default
+        v = column[self.i]
+        if v is _absent:
+            return default
+        return v
 
 class FilterDataTable(Action):
     '''
+    Gets the rows matching all filters, a filter is a value
+    or a list of values of the key:
+        {'asset': ['dog', 'cat'], 'step': 'rig'}
+    A Table input is filtered by the indexes of its columns.
+    
+    where: an expression the rows must match too, see compileWhere:
+        "asset_type in ['chr', 'prp'] and (step == 'rig' or not name =~ '_bak$')"
     '''
     
     _defaultParms = {       
         'input': '',
-        'filters': {}
+        'filters': {},
+        'where': '',
+        'as_table': None,
     }
     
     def run(self):
-        result = []
-        
         data = self.parm('input')
         filters = self.parm('filters')
+        if not filters:
+            filters = {}
         #print "filters:",filters
+        
+        where = self.parm('where')
+        match = compileWhere(where) if where else None
+        
+        if isinstance(data, Table):
+            positions = data.matches(filters)
+            if match:
+                row = _RowView(data._columns)
+                temp = []
+                for i in positions:
+                    row.i = i
+                    if match(row):
+                        temp.append(i)
+                positions = temp
+            return _tableOutput(self, data.take(positions), True)
+        
+        if not data:
+            data = []
+        
+        checks = []
+        for f in filters.keys():
+            if type(filters[f]) == list:
+                checks.append((f, filters[f]))
+            else:
+                checks.append((f, [filters[f]]))
+        
+        result = []
         for d in data:
-            tem = []
-            for f in filters.keys():
-                if type(filters[f]) == list:
-                    if d.get(f) in filters[f]:
-                        tem.append(0)
-                elif d.get(f) == filters[f]:
-                    tem.append(0)
-            
-            if len(tem) == len(filters):
-                result.append(d)
-        return result
+            for f,values in checks:
+                if d.get(f) not in values:
+                    break
+            else:
+                if match is None or match(d):
+                    result.append(d)
+        
+        return _tableOutput(self, result, False)
 
 class AddData(Action):
     
@@ -2481,6 +3592,166 @@ class GetCurrentRenderLayer(Action):
     
 
 
+_sessionCaches = weakref.WeakKeyDictionary()
+_sessionCachesLock = threading.Lock()
+def _sessionCache(engine, name):
+    '''
+    Gets a dict kept for the engine, it lives as long as the engine,
+    so the values are shared by the actions of one session.
+    '''
+    with _sessionCachesLock:
+        caches = _sessionCaches.setdefault(engine, {})
+        return caches.setdefault(name, {})
+
+class SceneInventory(object):
+    '''
+    A snapshot of the scene shared by the actions of an engine run,
+    so the scene is walked once instead of once for each action.
+    Each part is got from the software at the first use:
+    references, gpu caches, assembly references, and the results
+    of find and getChildren, which are mostly called by namespace.
+    It's only shared in a scene run, see beginSceneInventory,
+    actions changing the scene call invalidateSceneInventory.
+    '''
+    
+    def __init__(self, software):
+        self._software = software
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def software(self):
+        return self._software
+    
+    def _get(self, key, func, *args, **kwargs):
+        with self._lock:
+            if self._data.has_key(key):
+                return self._data[key]
+        
+        value = func(*args, **kwargs)
+        with self._lock:
+            self._data[key] = value
+        return value
+    
+    def getReferenceObjects(self):
+        return list(self._get('references', self._software.getReferenceObjects))
+    
+    def getGpuCaches(self):
+        return list(self._get('gpu_caches', self._software.getGpuCaches))
+    
+    def getAssemblyReferences(self):
+        return list(self._get('assemblies', self._software.getAssemblyReferences))
+    
+    def getAllReferences(self):
+        '''Gets references, gpu caches and assembly references.'''
+        return self.getReferenceObjects() + self.getGpuCaches() + self.getAssemblyReferences()
+    
+    def getNamespaces(self):
+        '''Gets the namespaces of all references.'''
+        return sorted(self.getReferencesByNamespace().keys())
+    
+    def getReferencesByNamespace(self):
+        def index():
+            result = {}
+            for ref in self.getAllReferences():
+                ns = ref.get('namespace')
+                if ns:
+                    result.setdefault(ns, []).append(ref)
+            return result
+        
+        temp = self._get('namespaces', index)
+        return dict([(k, list(v)) for k,v in temp.items()])
+    
+    def find(self, **kwargs):
+        key = ('find', json.dumps(kwargs, sort_keys=True, default=repr))
+        return list(self._get(key, self._software.find, **kwargs))
+    
+    def getChildren(self, obj, **kwargs):
+        path = obj.fullPath() if hasattr(obj, 'fullPath') else obj
+        key = ('children', path, json.dumps(kwargs, sort_keys=True, default=repr))
+        return list(self._get(key, self._software.getChildren, obj, **kwargs))
+
+def beginSceneInventory(engine):
+    '''
+    Starts a scene run of the engine, the following actions share one
+    SceneInventory until endSceneInventory. Out of a scene run each
+    getSceneInventory call walks the scene again, since the artist
+    may change the scene between the runs.
+    '''
+    temp = _sessionCache(engine, 'scene_inventory')
+    with _sessionCachesLock:
+        temp['open'] = True
+        temp.pop('inventory', None)
+
+def endSceneInventory(engine):
+    '''Ends the scene run of the engine and drops its SceneInventory.'''
+    temp = _sessionCache(engine, 'scene_inventory')
+    with _sessionCachesLock:
+        temp['open'] = False
+        temp.pop('inventory', None)
+
+def isSceneInventoryOpen(engine):
+    return bool(_sessionCache(engine, 'scene_inventory').get('open'))
+
+def getSceneInventory(engine, software):
+    '''
+    Gets the SceneInventory of the scene run of the engine,
+    it's made at the first call. Out of a scene run a new one is made.
+    '''
+    temp = _sessionCache(engine, 'scene_inventory')
+    with _sessionCachesLock:
+        if not temp.get('open'):
+            return SceneInventory(software)
+        
+        inventory = temp.get('inventory')
+        if inventory is None:
+            inventory = SceneInventory(software)
+            temp['inventory'] = inventory
+        return inventory
+
+def invalidateSceneInventory(engine):
+    '''Drops the SceneInventory of the engine, it will be made again.'''
+    _sessionCache(engine, 'scene_inventory').pop('inventory', None)
+
+def getAssetIds(database, keys, memo=None):
+    '''
+    Gets the ids of the assets.
+        keys: a list of (project, assetType, asset), assetType can be None.
+        memo: a dict of the known ids, only unknown keys are queried.
+    If the database has getAssetIds, all unknown ids are got in one query:
+        database.getAssetIds([(project, assetType, asset), ...])
+        return: [id1, id2, ...]
+    otherwise getAssetId is called for each of them.
+    Returns a list of ids in the order of the keys, None if it's not found.
+    Assets not found are not kept in the memo, they may be made later.
+    '''
+    if memo is None:
+        memo = {}
+    
+    unknown = []
+    for key in keys:
+        if key not in memo and key not in unknown:
+            unknown.append(key)
+    
+    found = {}
+    if unknown:
+        if hasattr(database, 'getAssetIds'):
+            found = dict(zip(unknown, database.getAssetIds(unknown)))
+        else:
+            for project,assetType,asset in unknown:
+                kwargs = {
+                    'project': project,
+                    'asset': asset
+                }
+                if assetType is not None:
+                    kwargs['assetType'] = assetType
+                found[(project, assetType, asset)] = database.getAssetId(**kwargs)
+        
+        for key in unknown:
+            if found.get(key) is not None:
+                memo[key] = found[key]
+    
+    return [memo.get(key, found.get(key)) for key in keys]
+
 class SetShotLinkedAssets(Action):
     '''
     Sets linked assets of the shot on database based on
@@ -2491,9 +3762,7 @@ class SetShotLinkedAssets(Action):
         sw = self.software()
         if sw:
             # Get referenced scene assets
-            refs = sw.getReferenceObjects()
-            refs += sw.getGpuCaches()
-            refs += sw.getAssemblyReferences()
+            refs = getSceneInventory(self.engine(), sw).getAllReferences()
             
             paths = []
             for i in refs:
@@ -2501,19 +3770,16 @@ class SetShotLinkedAssets(Action):
                 if path not in paths:
                     paths.append(path)
             
-            assetIds = []
+            keys = []
             for path in paths:
-                info = self.engine().getInfoFromPath(path, enableCache=True)
+                info = self.getInfoFromPath(path)
                 
                 if info:
-                    kwargs = {
-                        'project': info.get('project'),
-                        'assetType': info.get('sequence'), 
-                        'asset': info.get('shot')
-                    }
-                    id_ = self.database().getAssetId(**kwargs)
-                    if id_:
-                        assetIds.append(id_)
+                    keys.append((info.get('project'), info.get('sequence'), info.get('shot')))
+            
+            memo = _sessionCache(self.engine(), 'asset_ids')
+            ids = getAssetIds(self.database(), keys, memo=memo)
+            assetIds = [id_ for id_ in ids if id_]
             
             if assetIds:
                 project = self.project()
@@ -2550,15 +3816,10 @@ class SetShotLinkedAssets2(Action):
                     if asset not in assets:
                         assets.append(asset)
             
-            assetIds = []
-            for asset in assets:
-                kwargs = {
-                    'project': self.project(),
-                    'asset': asset
-                }
-                id_ = self.database().getAssetId(**kwargs)
-                if id_:
-                    assetIds.append(id_)
+            keys = [(self.project(), None, asset) for asset in assets]
+            memo = _sessionCache(self.engine(), 'asset_ids')
+            ids = getAssetIds(self.database(), keys, memo=memo)
+            assetIds = [id_ for id_ in ids if id_]
             
             #print
             #print 'assetIds:'
@@ -2655,14 +3916,15 @@ class GetAnimationPublishedObjects(Action):
         
         sw = self.software()
         if sw:
-            refs = sw.getReferenceObjects()
+            inventory = getSceneInventory(self.engine(), sw)
+            refs = inventory.getReferenceObjects()
             #temp = self._software.getReferences()
             for ref in refs:
                 #print
                 #print 'ref:',ref
                 # ref: {name:'', code:'', full_name:'', namespace:'', path:''}
                 
-                info = self.engine().getInfoFromPath(ref['path'], enableCache=True)
+                info = self.getInfoFromPath(ref['path'])
                 #print
                 #print 'info:',info
                 
@@ -2675,13 +3937,13 @@ class GetAnimationPublishedObjects(Action):
                         'namespace': ref['namespace'],
                     }
                     #print 'kwargs:',kwargs
-                    objs = sw.find(**kwargs)
+                    objs = inventory.find(**kwargs)
                     if objs:
                         obj = objs[0]
                         
                         #print 'obj:',obj
                         
-                        for t in sw.getChildren(obj):
+                        for t in inventory.getChildren(obj):
                             d = {}
                             d['namespace'] = ref['namespace']
                             d['asset_type'] = info.get('sequence')
@@ -2752,9 +4014,10 @@ class GetAnimationPublishedObjects2(Action):
             index = self.parm('index')
             newKey = 'asset'
             
-            temp = sw.find(name=key, type=typ, fullPath=True)
+            inventory = getSceneInventory(self.engine(), sw)
+            temp = inventory.find(name=key, type=typ, fullPath=True)
             for t in temp:
-                for c in sw.getChildren(t, type=typ):
+                for c in inventory.getChildren(t, type=typ):
                     token = pat.findall(c.name())
                     if token:
                         value = token[0]
@@ -2796,14 +4059,15 @@ class GetAnimationPublishedObjects3(Action):
         
         sw = self.software()
         if sw:
-            refs = sw.getReferenceObjects()
+            inventory = getSceneInventory(self.engine(), sw)
+            refs = inventory.getReferenceObjects()
             #temp = self._software.getReferences()
             for ref in refs:
                 #print
                 #print 'ref:',ref
                 # ref: {name:'', code:'', full_name:'', namespace:'', path:''}
                 
-                info = self.engine().getInfoFromPath(ref['path'], enableCache=True)
+                info = self.getInfoFromPath(ref['path'])
                 #print
                 #print 'info:',info
                 
@@ -2816,13 +4080,13 @@ class GetAnimationPublishedObjects3(Action):
                         'namespace': ref['namespace'],
                     }
                     #print 'kwargs:',kwargs
-                    objs = sw.find(**kwargs)
+                    objs = inventory.find(**kwargs)
                     if objs:
                         obj = objs[0]
                         
                         #print 'obj:',obj
                         
-                        for t in sw.getChildren(obj):
+                        for t in inventory.getChildren(obj):
                             d = {}
                             d['namespace'] = ref['namespace']
                             d['asset_type'] = info.get('sequence')
@@ -2862,7 +4126,7 @@ class GetAnimationPublishedObjects3(Action):
                         'namespace': ref['namespace'],
                     }
                     #print 'kwargs:',kwargs
-                    objs = sw.find(**kwargs2)
+                    objs = inventory.find(**kwargs2)
                     if objs:
                         obj = objs[0]
                     
@@ -2990,6 +4254,32 @@ class GetWorkfileId(Action):
         if temp:
             return temp[0]['version.id']
 
+class _LockedDatabase(object):
+    '''
+    Calls the methods of the database one at a time, the CGTeamwork
+    client is not thread safe, see getCgtwClient.
+    '''
+    
+    def __init__(self, database, lock):
+        self._database = database
+        self._lock = lock
+    
+    def __deepcopy__(self, memo):
+        return self
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        
+        attr = getattr(self._database, name)
+        if not callable(attr):
+            return attr
+        
+        def call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return call
+
 class GetAssemblyElements(Action):
     '''
     Finds the assembly elements for the shot.
@@ -3073,6 +4363,7 @@ class GetAssemblyElements(Action):
         },
         'elements_order': ['shape'],
         'default_asset_type': 'DEFAULT', 
+        'max_workers': 8,
         'elements': {
             'sets': {
                 'shape': [
@@ -3103,6 +4394,52 @@ class GetAssemblyElements(Action):
         }
     }
     
+    def getPublishedFiles(self, queries):
+        '''
+        Gets the published files of the queries, a query is the kwargs
+        of plcr.getPublishedFiles. Same queries are only run once,
+        different ones are run by max_workers threads, the database
+        calls of the threads are made one at a time.
+        Returns a list of files for each query, the repeated queries
+        get copies of the files so the units don't share them.
+        '''
+        keys = []
+        unique = collections.OrderedDict()
+        for kwargs in queries:
+            temp = dict(kwargs)
+            temp.pop('database', None)
+            key = json.dumps(temp, sort_keys=True, default=str)
+            keys.append(key)
+            if key not in unique:
+                unique[key] = kwargs
+        
+        maxWorkers = self.parm('max_workers')
+        if maxWorkers > 1 and len(unique) > 1:
+            lock = threading.Lock()
+            for key,kwargs in unique.items():
+                if kwargs.get('database') is not None:
+                    unique[key] = dict(kwargs, database=_LockedDatabase(kwargs['database'], lock))
+            
+            pool = ThreadPool(min(maxWorkers, len(unique)))
+            try:
+                files = pool.map(lambda kwargs: plcr.getPublishedFiles(**kwargs), unique.values())
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            files = [plcr.getPublishedFiles(**kwargs) for kwargs in unique.values()]
+        
+        found = dict(zip(unique.keys(), files))
+        result = []
+        used = set()
+        for key in keys:
+            if key in used:
+                result.append(copy.deepcopy(found[key]))
+            else:
+                used.add(key)
+                result.append(found[key])
+        return result
+    
     def run(self):
         plcr.clearConfigCache()
         
@@ -3159,8 +4496,13 @@ class GetAssemblyElements(Action):
         if not cameraInfo:
             cameraInfo = {}
         
+        # Collect the queries of the camera and the assets first,
+        # then get the files of all queries at once
+        queries = []
+        plans = []
+        
         if cameraInfo:
-            elements = {}
+            elements = []
             for key in cameraInfo.keys():
                 temp = []
                 for unit in cameraInfo[key]:
@@ -3174,24 +4516,17 @@ class GetAssemblyElements(Action):
                     }
                     kwargs.update(unit)
                     
-                    #print
-                    #print 'Getting published cameras'
-                    temp1 = plcr.getPublishedFiles(**kwargs)
-                    #print 'Done'
-                    
-                    temp += temp1
+                    temp.append(len(queries))
+                    queries.append(kwargs)
                 
-                if temp:
-                    elements[key] = temp
+                elements.append((key, temp))
             
-            if elements:
-                unit = {
-                    'asset': 'camera',
-                    'asset_type': '',
-                    'elements_order': elementsOrder, 
-                    'elements': elements
-                }
-                result.append(unit)
+            unit = {
+                'asset': 'camera',
+                'asset_type': '',
+                'elements_order': elementsOrder, 
+            }
+            plans.append((unit, elements, True))
         
         # Get normal assets
         for lay in layoutInfo:
@@ -3215,7 +4550,7 @@ class GetAssemblyElements(Action):
                 setup = elementsInfo.get(defaultAType)
             
             if setup:
-                elements = {}
+                elements = []
                 
                 for key in setup.keys():
                     temp = []
@@ -3246,33 +4581,43 @@ class GetAssemblyElements(Action):
                             kwargs.update(unit)
                         
                         #print
-                        #print 'Getting published files...'
                         #print 'kwargs:',kwargs
                         
-                        temp1 = plcr.getPublishedFiles(**kwargs)
-                        #print temp1
-                        #print 'Done'
-                        
-                        temp += temp1
+                        temp.append(len(queries))
+                        queries.append(kwargs)
                     
-                    elements[key] = temp
+                    elements.append((key, temp))
                 
-                if elements:
-                    unit = {
-                        'asset': asset,
-                        'asset_type': assetType,
-                        'elements_order': elementsOrder, 
-                        'elements': elements
-                    }
-                    
-                    if trans:
-                        unit['transform'] = trans
-                    if subs:
-                        unit['subs'] = subs
-                    
-                    result.append(unit)
+                unit = {
+                    'asset': asset,
+                    'asset_type': assetType,
+                    'elements_order': elementsOrder, 
+                }
+                
+                if trans:
+                    unit['transform'] = trans
+                if subs:
+                    unit['subs'] = subs
+                
+                plans.append((unit, elements, False))
         
-        plcr.clearConfigCache()
+        files = self.getPublishedFiles(queries)
+        
+        # Assemble the results in the layout order
+        for unit,elements,skipEmpty in plans:
+            unitElements = {}
+            for key,indexes in elements:
+                temp = []
+                for i in indexes:
+                    temp += files[i]
+                
+                # The camera only keeps elements which have files
+                if temp or not skipEmpty:
+                    unitElements[key] = temp
+            
+            if unitElements:
+                unit['elements'] = unitElements
+                result.append(unit)
         
         return result
 
@@ -3387,10 +4732,54 @@ class If(Action):
         
         return r
 
+def _cloneAction(action):
+    '''
+    Makes a copy of the action and its sub actions, with their own
+    parms and format keys, so the copies can run in other threads.
+    '''
+    clone = copy.copy(action)
+    formatKeys = getattr(action, '_formatKeys', None)
+    if type(formatKeys) == dict:
+        clone._formatKeys = formatKeys.copy()
+    parms = getattr(action, '_parms', None)
+    if type(parms) == dict:
+        clone._parms = copy.deepcopy(parms)
+    subs = getattr(action, '_subs', None)
+    if subs:
+        clone._subs = [_cloneAction(sub) for sub in subs]
+    return clone
+
+def _subsShareResults(subs):
+    '''
+    Checks whether a sub action refers to the result of another sub action.
+    The results are kept by the engine under the action names,
+    so these subs can't run for several items at the same time.
+    '''
+    for i,sub in enumerate(subs):
+        keys = _actionPlaceholders(sub)
+        for j,other in enumerate(subs):
+            if i != j and keys.intersection(_actionOutputs(other)):
+                return True
+    return False
+
 class ForLoop(Action):
+    '''
+    Runs the sub actions for each item of the input list.
+    
+    parallel:
+        False: run the items one by one
+        True or 'thread': run the items in a thread pool,
+            the result keeps the same order as the input list.
+            The items run one by one if a sub action refers to
+            the result of another sub action, or must run on the
+            host main thread, see _needsMainThread.
+    max_workers: max count of the threads in the pool
+    '''
     
     _defaultParms = {
         'input': '',
+        'parallel': False,
+        'max_workers': 4,
     }
     
     def count(self):
@@ -3399,30 +4788,72 @@ class ForLoop(Action):
         n2 = len(self.subs())
         return n1*n2
     
-    def run(self):
-        result = []
+    def runItem(self, info, subs=None):
+        '''Runs the sub actions for one input item.'''
+        if subs == None:
+            subs = self._subs
         
-        inputs = self.parm('input')
-        for info in inputs:
+        r = {}
+        for sub in subs:
             #print
-            #print 'ForLoop.info:'
-            #pprint.pprint(info)
+            #print 'sub:',sub
             #print
-            
-            r = {}
-            for sub in self._subs:
-                #print
-                #print 'sub:',sub
-                #print
-                sub.setFormatKeys(info)
-                r = self.engine().runAction(sub)
-            
-            result.append(r)
+            sub.setFormatKeys(info)
+            r = self.engine().runAction(sub)
         
-        return result
-
-class Boolean(Action):
-    '''
+        return r
+    
+    def runItemIsolated(self, info):
+        '''Runs the sub actions for one input item on cloned actions.'''
+        subs = [_cloneAction(sub) for sub in self._subs]
+        return self.runItem(info, subs=subs)
+    
+    def run(self):
+        inputs = self.parm('input')
+        if not inputs:
+            inputs = []
+        
+        parallel = self.parm('parallel')
+        maxWorkers = self.parm('max_workers')
+        if type(maxWorkers) != int or maxWorkers < 1:
+            maxWorkers = 1
+        
+        if parallel and parallel != 'thread' and parallel != True:
+            msg = 'ForLoop only supports thread parallel mode, not "%s"' % parallel
+            raise Exception(msg)
+        
+        if parallel and _subsShareResults(self._subs):
+            _log.info('ForLoop %s: sub actions refer to each other, running the items one by one', self.name)
+            parallel = False
+        
+        if parallel and any([_needsMainThread(sub) for sub in self._subs]):
+            _log.info('ForLoop %s: sub actions use the host software, running the items one by one', self.name)
+            parallel = False
+        
+        if parallel and maxWorkers > 1 and len(inputs) > 1:
+            pool = ThreadPool(min(maxWorkers, len(inputs)))
+            try:
+                # map keeps the order of the inputs
+                result = pool.map(self.runItemIsolated, inputs)
+            finally:
+                pool.close()
+                pool.join()
+            
+            return result
+        
+        result = []
+        for info in inputs:
+            #print
+            #print 'ForLoop.info:'
+            #pprint.pprint(info)
+            #print
+            
+            result.append(self.runItem(info))
+        
+        return result
+
+class Boolean(Action):
+    '''
     A boolean action.
     True to run sub node1, else to run sub node2.
     '''
@@ -3453,6 +4884,318 @@ class Boolean(Action):
         
         return r
 
+# The key before the first . or [, {ExportScene.path} and {files[0]} refer to ExportScene and files
+_placeholderPattern = re.compile('\{([a-zA-Z0-9_]+)(?:[\.\[][^{}]*)?\}')
+def _actionPlaceholders(action):
+    '''Gets the {placeholder} keys in the parms of the action and its subs.'''
+    keys = set()
+    
+    def collect(value):
+        if type(value) in (str, unicode):
+            keys.update(_placeholderPattern.findall(value))
+        elif type(value) == dict:
+            for v in value.values():
+                collect(v)
+        elif type(value) in (tuple, list):
+            for v in value:
+                collect(v)
+    
+    collect(getattr(action, '_parms', None))
+    
+    subs = getattr(action, '_subs', None)
+    if subs:
+        for sub in subs:
+            keys.update(_actionPlaceholders(sub))
+    
+    return keys
+
+def _actionOutputs(action):
+    '''Gets the keys which other actions use to refer to the result.'''
+    keys = []
+    name = getattr(action, 'name', None)
+    if name:
+        keys.append(name)
+    
+    parms = getattr(action, '_parms', None)
+    if type(parms) == dict:
+        key = parms.get('returned_key')
+        if key and key not in keys:
+            keys.append(key)
+    
+    return keys
+
+# Names in the code of an action which means it works with the host software,
+# these actions must stay on the main thread.
+_mainThreadNames = set(['software', 'maya', 'cmds', 'mel', 'pm', 'hou', 'nuke'])
+_mainThreadClasses = {}
+def _needsMainThread(action):
+    '''
+    Checks whether the action must run on the host main thread.
+    An action can set the class attribute mainThread to skip the checking,
+    otherwise we look for the host software names in the code of the class.
+    '''
+    flag = getattr(action, 'mainThread', None)
+    if flag != None:
+        return bool(flag)
+    
+    cls = type(action)
+    if not _mainThreadClasses.has_key(cls):
+        found = False
+        for c in cls.__mro__:
+            if c in (Action, plcr.Action, object):
+                break
+            for value in c.__dict__.values():
+                func = getattr(value, '__func__', value)
+                code = getattr(func, '__code__', None)
+                if code and _mainThreadNames.intersection(code.co_names):
+                    found = True
+                    break
+            if found:
+                break
+        _mainThreadClasses[cls] = found
+    
+    if _mainThreadClasses[cls]:
+        return True
+    
+    subs = getattr(action, '_subs', None)
+    if subs:
+        for sub in subs:
+            if _needsMainThread(sub):
+                return True
+    
+    return False
+
+# Last run time of the actions in seconds, used by the dry run
+_actionDurations = {}
+
+class ActionGraph(object):
+    '''
+    A dependency graph of actions.
+    
+    Action B depends on action A when:
+        a parm of B (or of the subs of B) has a placeholder of A's name
+        or A's returned_key, and A comes before B.
+        both of A and B must run on the main thread and A comes before B,
+        so the host software sees the actions in the template order.
+    
+    Sub actions of If, Boolean and ForLoop belong to their parent node.
+    '''
+    
+    def __init__(self, actions):
+        self.actions = list(actions)
+        self.mainThread = [_needsMainThread(a) for a in self.actions]
+        self.deps = []
+        
+        writers = {}
+        lastMain = None
+        for i,action in enumerate(self.actions):
+            deps = set()
+            for key in _actionPlaceholders(action):
+                if writers.has_key(key):
+                    deps.add(writers[key])
+            
+            # Keep the order of the actions writing the same key
+            for key in _actionOutputs(action):
+                if writers.has_key(key):
+                    deps.add(writers[key])
+                writers[key] = i
+            
+            if self.mainThread[i]:
+                if lastMain != None:
+                    deps.add(lastMain)
+                lastMain = i
+            
+            self.deps.append(deps)
+    
+    def estimate(self, action, estimates=None):
+        '''Gets estimated run time of the action in seconds.'''
+        name = getattr(action, 'name', None)
+        if estimates and estimates.has_key(name):
+            return float(estimates[name])
+        return _actionDurations.get(name, 1.0)
+    
+    def criticalPath(self, estimates=None):
+        '''
+        Gets the critical path of the graph.
+        Returns a dictionary:
+            {
+                'critical_path': [action names],
+                'wall_time': 12.0,
+                'serial_time': 30.0
+            }
+        '''
+        finish = []
+        previous = []
+        serialTime = 0.0
+        for i,action in enumerate(self.actions):
+            t = self.estimate(action, estimates)
+            serialTime += t
+            
+            start = 0.0
+            pre = None
+            for d in self.deps[i]:
+                if finish[d] > start or pre == None:
+                    start = max(start, finish[d])
+                    pre = d
+            
+            finish.append(start + t)
+            previous.append(pre)
+        
+        path = []
+        wallTime = 0.0
+        if finish:
+            i = finish.index(max(finish))
+            wallTime = finish[i]
+            while i != None:
+                path.insert(0, getattr(self.actions[i], 'name', str(i)))
+                i = previous[i]
+        
+        result = {
+            'critical_path': path,
+            'wall_time': wallTime,
+            'serial_time': serialTime
+        }
+        return result
+    
+    def run(self, engine, maxWorkers=4):
+        '''
+        Runs the actions with the engine.
+        Actions which are ready run in a thread pool,
+        main thread actions run in the current thread.
+        Returns the results in the order of the actions.
+        '''
+        import Queue
+        
+        n = len(self.actions)
+        results = [None] * n
+        waiting = [set(d) for d in self.deps]
+        users = [[] for i in range(n)]
+        for i in range(n):
+            for d in self.deps[i]:
+                users[d].append(i)
+        
+        done = Queue.Queue()
+        
+        def runNode(i):
+            start = time.time()
+            try:
+                r = engine.runAction(self.actions[i])
+                done.put((i, r, None, time.time()-start))
+            except:
+                done.put((i, None, sys.exc_info(), time.time()-start))
+        
+        pool = None
+        if maxWorkers > 1 and not all(self.mainThread):
+            pool = ThreadPool(maxWorkers)
+        
+        ready = [i for i in range(n) if not waiting[i]]
+        running = 0
+        finished = 0
+        error = None
+        try:
+            while finished < n:
+                if error == None:
+                    # Send ready worker nodes to the pool
+                    mainReady = []
+                    for i in ready:
+                        if self.mainThread[i] or pool == None:
+                            mainReady.append(i)
+                        else:
+                            pool.apply_async(runNode, (i,))
+                            running += 1
+                    ready = mainReady
+                
+                if ready and error == None:
+                    # Run main thread node in current thread
+                    i = min(ready)
+                    ready.remove(i)
+                    runNode(i)
+                    running += 1
+                
+                elif running == 0:
+                    break
+                
+                i,r,exc,duration = done.get()
+                running -= 1
+                finished += 1
+                
+                name = getattr(self.actions[i], 'name', None)
+                if name:
+                    _actionDurations[name] = duration
+                
+                if exc:
+                    if error == None:
+                        error = exc
+                    continue
+                
+                results[i] = r
+                for u in users[i]:
+                    waiting[u].discard(i)
+                    if not waiting[u]:
+                        ready.append(u)
+        
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        
+        if error:
+            raise error[0], error[1], error[2]
+        
+        return results
+
+class Schedule(Action):
+    '''
+    Runs the sub actions as a dependency graph.
+    Sub actions which don't depend on each other run at the same time
+    in a thread pool, actions working with the host software
+    (anything calling self.software()) stay on the main thread.
+    The sub actions share one SceneInventory, see beginSceneInventory.
+    
+    max_workers: max count of the threads in the pool
+    dry_run: don't run the actions, just print the critical path
+        and the estimated wall time
+    estimates: estimated run time in seconds of the actions,
+        like {'ExportCameras': 12.5}, defaults to time of last run
+    '''
+    
+    _defaultParms = {
+        'max_workers': 4,
+        'dry_run': False,
+        'estimates': {},
+    }
+    
+    def run(self):
+        subs = self._subs
+        for sub in subs:
+            sub.setFormatKeys(self._formatKeys)
+        
+        graph = ActionGraph(subs)
+        
+        if self.parm('dry_run'):
+            r = graph.criticalPath(estimates=self.parm('estimates'))
+            print
+            print 'Critical path:'
+            print '    ' + ' -> '.join(r['critical_path'])
+            print 'Estimated wall time: %.2fs' % r['wall_time']
+            print 'Estimated serial time: %.2fs' % r['serial_time']
+            return r
+        
+        maxWorkers = self.parm('max_workers')
+        if type(maxWorkers) != int or maxWorkers < 1:
+            maxWorkers = 1
+        
+        # A Schedule in a scene run doesn't end it
+        engine = self.engine()
+        opened = not isSceneInventoryOpen(engine)
+        if opened:
+            beginSceneInventory(engine)
+        try:
+            return graph.run(engine, maxWorkers=maxWorkers)
+        finally:
+            if opened:
+                endSceneInventory(engine)
+
 class ExportScene(Action):
     
     _defaultParms = {
@@ -3648,6 +5391,8 @@ class CreateAssemblyDefinitionScene(Action):
     progressText = 'Creating assembly scene...'
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         files = self.parm('files')
         if sw and files:
@@ -3669,6 +5414,8 @@ class CreateAssemblyReferenceScene(Action):
     }
     
     def run(self):
+        invalidateSceneInventory(self.engine())
+        
         sw = self.software()
         if sw:
             name = self.parm('name')
@@ -3748,16 +5495,422 @@ class ExportMaterials2(Action):
                                 configs=configs, objects=objs)
             return output
 
-def getFileMd5(path):
-    import md5
+_hashChunkSize = 4*1024*1024
+
+def _newHasher(algorithm):
+    '''
+    Gets a new hash object and the real algorithm name.
+    algorithm: md5, sha1 or fast.
+        fast uses xxhash if it's installed, otherwise md5.
+    '''
+    import hashlib
+    
+    if algorithm == 'fast':
+        try:
+            import xxhash
+            return xxhash.xxh64(),'xxh64'
+        except ImportError:
+            algorithm = 'md5'
+    
+    return hashlib.new(algorithm),algorithm
+
+class _FileHashCache(object):
+    '''
+    Keeps hashes of the files in a json file of the local settings folder,
+    a hash is reused when path, size, modified time and inode of the file
+    are not changed.
+    Each entry keeps the last used time, entries not used for maxAge
+    seconds are dropped, and only the last used maxSize entries are kept.
+    The file is merged with the one on the disk and written to a temp
+    file first, so several sessions on the machine don't break it.
+    '''
+    
+    def __init__(self, maxSize=20000, maxAge=30*24*3600):
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self._data = None
+        self._dirty = False
+        self._lock = threading.Lock()
+    
+    def path(self):
+        root = plcr._localSettingsPath()
+        return '%s/file_hashes.json' % root
+    
+    def _read(self):
+        '''Reads the entries of the file, an entry is [stamp, digest, used time].'''
+        data = {}
+        try:
+            f = open(self.path(), 'r')
+            try:
+                data = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError, ValueError):
+            pass
+        
+        if type(data) != dict:
+            return {}
+        
+        # Drop the entries of the old format
+        result = {}
+        for key,value in data.iteritems():
+            if type(value) == list and len(value) == 3 and type(value[0]) == list:
+                result[key] = value
+        return result
+    
+    def _load(self):
+        if self._data == None:
+            self._data = self._read()
+    
+    def get(self, key, stamp):
+        with self._lock:
+            self._load()
+            value = self._data.get(key)
+            if value and value[0] == stamp:
+                value[2] = time.time()
+                self._dirty = True
+                return value[1]
+    
+    def set(self, key, stamp, digest):
+        with self._lock:
+            self._load()
+            self._data[key] = [stamp, digest, time.time()]
+            self._dirty = True
+    
+    def _prune(self, data):
+        oldest = time.time() - self.maxAge
+        items = [(v[2], k) for k,v in data.iteritems() if v[2] >= oldest]
+        if len(items) > self.maxSize:
+            items.sort(reverse=True)
+            items = items[:self.maxSize]
+        return dict([(k, data[k]) for t,k in items])
+    
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            
+            # Keep the entries written by other sessions
+            data = self._read()
+            for key,value in self._data.iteritems():
+                old = data.get(key)
+                if old == None or old[2] <= value[2]:
+                    data[key] = value
+            data = self._prune(data)
+            
+            path = self.path()
+            temp = '%s.%s.tmp' % (path, os.getpid())
+            try:
+                makeFolder(path)
+                f = open(temp, 'w')
+                try:
+                    f.write(json.dumps(data))
+                finally:
+                    f.close()
+                
+                try:
+                    os.rename(temp, path)
+                except OSError:
+                    # Windows can't rename to an existing file
+                    _removeFile(path)
+                    os.rename(temp, path)
+                
+                self._data = data
+                self._dirty = False
+            except (IOError, OSError):
+                try:
+                    _removeFile(temp)
+                except OSError:
+                    pass
+
+_fileHashCache = _FileHashCache()
+
+def getFileHash(path, algorithm='md5', useCache=True):
+    '''
+    Gets hash of the file, the file is read by chunks so big files
+    don't take much memory.
+    algorithm: md5, sha1 or fast
+    Returns None if the path is not a file.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    
+    if not stat.S_ISREG(st.st_mode):
+        return
+    
+    hasher,algorithm = _newHasher(algorithm)
     
-    if os.path.isfile(path):
-        f = open(path, 'rb')
-        txt = f.read()
+    key = '%s|%s' % (algorithm, os.path.abspath(path).replace('\\', '/'))
+    stamp = [st.st_size, st.st_mtime, st.st_ino]
+    if useCache:
+        digest = _fileHashCache.get(key, stamp)
+        if digest:
+            return digest
+    
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(_hashChunkSize)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    finally:
         f.close()
+    
+    digest = hasher.hexdigest()
+    
+    # Don't keep the hash of a file which is just modified,
+    # the modified time may not change if it's modified again at once.
+    if useCache and st.st_mtime < time.time() - 2:
+        _fileHashCache.set(key, stamp, digest)
+    
+    return digest
+
+def saveFileHashCache():
+    '''Writes the cached file hashes to the disk.'''
+    _fileHashCache.save()
+
+def getFileMd5(path):
+    return getFileHash(path, algorithm='md5')
+
+def _removeFile(path):
+    '''
+    Removes the file, read only files are removed too.
+    A file with other hard links is only unlinked, the mode is shared
+    by the links, changing it makes the stored file writable.
+    '''
+    if os.path.islink(path):
+        os.remove(path)
+    elif os.path.exists(path):
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+        else:
+            os.chmod(path, stat.S_IWRITE | stat.S_IREAD)
+            os.remove(path)
+
+def getTextureStoreBlob(store, digest, ext=''):
+    '''
+    Gets path of the file in the content addressable store.
+    Example:
+        store: //nas/TST/texture_store
+        digest: 8d777f385d3dfec8815d20f7496026dc
+        ext: .tif
+        return: //nas/TST/texture_store/8d/8d777f385d3dfec8815d20f7496026dc.tif
+    '''
+    return '%s/%s/%s%s' % (store, digest[:2], digest, ext)
+
+def storeFile(src, store, algorithm='md5'):
+    '''
+    Puts the file into the content addressable store,
+    the file is copied only if the store doesn't have it.
+    Returns path of the file in the store.
+    '''
+    return _storeFile(src, store, algorithm)[0]
+
+def _storeFile(src, store, algorithm):
+    '''Same as storeFile, returns the blob path and whether it's put by this call.'''
+    digest = getFileHash(src, algorithm=algorithm)
+    if not digest:
+        return None,False
+    
+    ext = os.path.splitext(src)[-1].lower()
+    blob = getTextureStoreBlob(store, digest, ext)
+    created = False
+    if not os.path.isfile(blob):
+        makeFolder(blob)
+        
+        # Copy to a temp file first, others never see a half copied blob
+        temp = '%s.%s.%s.tmp' % (blob, os.getpid(), id(blob))
+        shutil.copyfile(src, temp)
+        os.chmod(temp, stat.S_IREAD)
+        try:
+            os.rename(temp, blob)
+            created = True
+        except OSError:
+            # Windows can't rename to an existing file,
+            # another process has put the same file
+            _removeFile(temp)
+            if not os.path.isfile(blob):
+                raise
+    
+    return blob,created
+
+def _fsPath(path):
+    if type(path) == str:
+        return path.decode(sys.getfilesystemencoding())
+    return path
+
+def _hardLink(src, dst):
+    '''Makes a hard link, with CreateHardLinkW on Windows where Python 2 has no os.link.'''
+    if hasattr(os, 'link'):
+        os.link(src, dst)
+        return
+    
+    import ctypes
+    if not ctypes.windll.kernel32.CreateHardLinkW(_fsPath(dst), _fsPath(src), None):
+        raise ctypes.WinError()
+
+def _reflink(src, dst):
+    '''Clones the file on file systems supporting reflink, like btrfs and xfs.'''
+    import fcntl
+    
+    FICLONE = 0x40049409
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+
+def linkFile(src, dst, mode='hardlink'):
+    '''
+    Makes the dst path point to the src file.
+    mode:
+        hardlink: makes a hard link
+        reflink: makes a copy on write clone
+        symlink: makes a symbolic link
+        copy: copies the file
+    If the link can't be made on the file system, the file is copied.
+    '''
+    src = src.replace('\\', '/')
+    dst = dst.replace('\\', '/')
+    if src == dst:
+        return dst
+    
+    if not _makeLink(src, dst, mode):
+        shutil.copyfile(src, dst)
+    return dst
+
+def _makeLink(src, dst, mode):
+    '''Makes the link of linkFile, returns False if it can't be made.'''
+    makeFolder(dst)
+    _removeFile(dst)
+    
+    try:
+        if mode == 'hardlink':
+            _hardLink(src, dst)
+            return True
         
-        result = md5.new(txt)
-        return result.hexdigest()
+        elif mode == 'symlink':
+            os.symlink(src, dst)
+            return True
+        
+        elif mode == 'reflink':
+            _reflink(src, dst)
+            return True
+    
+    except (AttributeError, ImportError, IOError, OSError):
+        # os.symlink is not available on Windows with Python 2,
+        # hard links and reflinks can't be made across devices
+        _removeFile(dst)
+    
+    return False
+
+def canLinkFile(mode):
+    '''Checks whether linkFile can make the link of the mode on this system.'''
+    if mode == 'hardlink':
+        return hasattr(os, 'link') or os.name == 'nt'
+    elif mode == 'symlink':
+        return hasattr(os, 'symlink')
+    elif mode == 'reflink':
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        return True
+    return False
+
+def _deviceOf(path):
+    '''Gets the device of the path or its nearest existing folder, None if it's unknown.'''
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+    # Windows with Python 2 gives 0
+    return os.stat(path).st_dev or None
+
+def publishFile(src, dst, store='', linkMode='hardlink', algorithm='md5'):
+    '''
+    Publishes the src file to dst.
+    If store is given, the file is put into the content addressable store
+    and dst is linked to the stored file, otherwise the file is copied.
+    The file is copied without the store when the link can't be made,
+    like symlink on Windows, or hardlink and reflink to another device,
+    so it's never written twice. A blob put for a failed link is removed.
+    '''
+    if store and canLinkFile(linkMode):
+        sameDevice = True
+        if linkMode in ('hardlink', 'reflink'):
+            devices = [_deviceOf(store), _deviceOf(dst)]
+            sameDevice = None in devices or devices[0] == devices[1]
+        
+        if sameDevice:
+            blob,created = _storeFile(src, store, algorithm)
+            if blob:
+                if _makeLink(blob.replace('\\', '/'), dst.replace('\\', '/'), linkMode):
+                    return dst
+                if created:
+                    _removeFile(blob)
+    
+    makeFolder(dst)
+    copyFile(src, dst)
+    return dst
+
+def collectTextureStoreGarbage(store, roots=None, dryRun=False):
+    '''
+    Removes the files in the store which are not used by any published file.
+    A file is used if it has other hard links, or if a symbolic link
+    under the roots points to it.
+    roots must be given if the store has files without other hard links,
+    they may be used by symbolic links, use [] for a store only used
+    by hard links.
+    Returns the removed paths.
+    '''
+    store = os.path.realpath(store).replace('\\', '/')
+    if not os.path.isdir(store):
+        return []
+    
+    # Find symbolic links pointing into the store
+    linked = set()
+    for root in roots or []:
+        for folder,dirs,files in os.walk(root):
+            for f in files:
+                path = os.path.join(folder, f)
+                if os.path.islink(path):
+                    linked.add(os.path.realpath(path).replace('\\', '/'))
+    
+    removed = []
+    for folder,dirs,files in os.walk(store):
+        for f in files:
+            path = os.path.join(folder, f).replace('\\', '/')
+            if f.endswith('.tmp'):
+                continue
+            
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            
+            if st.st_nlink > 1 or path in linked:
+                continue
+            
+            if roots == None:
+                msg = 'The texture store has files which may be used by symbolic links, ' \
+                      'roots of the published files are needed: %s' % path
+                raise ValueError(msg)
+            
+            if not dryRun:
+                _removeFile(path)
+            removed.append(path)
+    
+    return removed
 
 class ExportTextures(Action):
     '''
@@ -3779,6 +5932,10 @@ class ExportTextures(Action):
         'material_path': '',
         'output': '',
         'version_pattern': '_v###',
+        'use_version_index': True,
+        'hash_algorithm': 'md5',
+        'texture_store': '',
+        'link_mode': 'hardlink',
     }
     
     def run(self):
@@ -3787,6 +5944,10 @@ class ExportTextures(Action):
             matPath = self.parm('material_path')
             output = self.parm('output')
             pattern = self.parm('version_pattern')
+            useIndex = self.parm('use_version_index')
+            algorithm = self.parm('hash_algorithm')
+            store = self.parm('texture_store')
+            linkMode = self.parm('link_mode')
             
             textures = sw.getTexturePaths()
             
@@ -3797,19 +5958,16 @@ class ExportTextures(Action):
                     filename = os.path.basename(texPath)
                     baseName,ext = os.path.splitext(filename)
                     folder = '%s/%s' % (output, baseName)
-                    if os.path.exists(folder):
-                        files = os.listdir(folder)
-                    else:
+                    if not os.path.exists(folder):
                         os.makedirs(folder)
-                        files = []
                     
                     filePattern = '%s%s%s' % (baseName, pattern, ext)
-                    r = getLatestVersion(files, filePattern)
+                    r = getLatestVersionInFolder(folder, filePattern, useIndex=useIndex)
                     
                     # Check md5
                     latestPath = '%s/%s' % (folder, r['latest_file'])
-                    latestMd5 = getFileMd5(latestPath)
-                    fileMd5 = getFileMd5(texPath)
+                    latestMd5 = getFileHash(latestPath, algorithm=algorithm)
+                    fileMd5 = getFileHash(texPath, algorithm=algorithm)
                     #print '%s: %s' % (latestPath, latestMd5)
                     #print '%s: %s' % (texPath, fileMd5)
                     if fileMd5 == latestMd5:
@@ -3817,10 +5975,18 @@ class ExportTextures(Action):
                     else:
                         # Copy the target file to versions folder
                         targetPath = '%s/%s' % (folder, r['current_file'])
-                        copyFile(texPath, targetPath)
+                        publishFile(texPath, targetPath, store=store,
+                                    linkMode=linkMode, algorithm=algorithm)
+                        
+                        if useIndex:
+                            recordVersion(folder, filePattern,
+                                          r['current_version_number'],
+                                          r['current_file'])
                     
                     pathInfo[texPath] = targetPath
             
+            saveFileHashCache()
+            
             if matPath:
                 sw.replaceTexturePaths(matPath, pathInfo)
 
@@ -3831,6 +5997,9 @@ class ExportTextures2(Action):
         'textures': [], 
         'material_path': '',
         'output': '',
+        'hash_algorithm': 'md5',
+        'texture_store': '',
+        'link_mode': 'hardlink',
     }
     
     def run(self):
@@ -3839,6 +6008,9 @@ class ExportTextures2(Action):
             matPath = self.parm('material_path')
             output = self.parm('output')
             textures = self.parm('textures')
+            algorithm = self.parm('hash_algorithm')
+            store = self.parm('texture_store')
+            linkMode = self.parm('link_mode')
             
             if not textures:
                 textures = sw.getTexturePaths().values()
@@ -3850,27 +6022,68 @@ class ExportTextures2(Action):
                     targetPath = '%s/%s' % (output, filename)
                     
                     # Check md5
-                    texPathMd5 = getFileMd5(texPath)
-                    targetPathMd5 = getFileMd5(targetPath)
+                    texPathMd5 = getFileHash(texPath, algorithm=algorithm)
+                    targetPathMd5 = getFileHash(targetPath, algorithm=algorithm)
                     #print '%s: %s' % (latestPath, latestMd5)
                     #print '%s: %s' % (texPath, fileMd5)
                     if texPathMd5 != targetPathMd5:
                         makeFolder(targetPath)
-                        copyFile(texPath, targetPath)
+                        publishFile(texPath, targetPath, store=store,
+                                    linkMode=linkMode, algorithm=algorithm)
                     
                     pathInfo[texPath] = targetPath
             
+            saveFileHashCache()
+            
             if matPath:
                 sw.replaceTexturePaths(matPath, pathInfo)
             
 
+def _exportTextures(jobs, algorithm='md5', store='', linkMode='hardlink'):
+    '''
+    Copies the source files to the target path in order,
+    only copies the file which is different with the target file.
+    jobs is a tuple of the target path and the list of the source paths.
+    Returns the source paths which are files.
+    '''
+    targetPath,srcPaths = jobs
+    
+    result = []
+    for texPath in srcPaths:
+        if os.path.isfile(texPath):
+            # Check md5
+            texPathMd5 = getFileHash(texPath, algorithm=algorithm)
+            targetPathMd5 = getFileHash(targetPath, algorithm=algorithm)
+            if texPathMd5 != targetPathMd5:
+                makeFolder(targetPath)
+                publishFile(texPath, targetPath, store=store,
+                            linkMode=linkMode, algorithm=algorithm)
+            
+            result.append(texPath)
+    
+    return result
+
 class ExportTextures3(Action):
-    '''Copy textures to the target folder, override the existing files.'''
+    '''
+    Copy textures to the target folder, override the existing files.
+    
+    workers: count of the threads to hash and copy the textures,
+        the texture list is collected on the main thread first,
+        then each target file is copied in a thread.
+        0 or 1 to copy the textures one by one.
+    texture_store: root of the content addressable texture store,
+        textures are linked to the files in the store with link_mode
+        instead of copying, see publishFile.
+    '''
     
     _defaultParms = {
         'output': '',
         'replaceOutput':'',
         'rsNormalMap':False,
+        'hash_algorithm': 'md5',
+        'workers': 0,
+        'texture_store': '',
+        'link_mode': 'hardlink',
     }
     
     def run(self):
@@ -3880,38 +6093,64 @@ class ExportTextures3(Action):
             output = self.parm('output')
             replaceOutput =  self.parm('replaceOutput')
             rsNormalMap = self.parm('rsNormalMap')
+            algorithm = self.parm('hash_algorithm')
+            workers = self.parm('workers')
+            store = self.parm('texture_store')
+            linkMode = self.parm('link_mode')
             
             #print "rsNormalMap:",rsNormalMap
             textures = sw.getTexturePaths2(rsNormalMap = rsNormalMap)
-            pathInfo = []
             # textures: {'file':{'fileNodes':[],}}
             
+            # Collect textures, group the source files by the target path
+            items = []
+            jobs = []
+            srcPaths = {}
             for typ in textures.keys():
                 texDic = textures[typ]
                 for fn in texDic.keys():
                     texPathList = texDic[fn]
                     for texPath in texPathList:
-    
-                        if os.path.isfile(texPath):
-                            texPath = texPath.replace('\\','/')
-                            
-                            filename = os.path.basename(texPath)
-                            targetPath = '%s/%s' % (output, filename)
-                            
-                            # Check md5
-                            texPathMd5 = getFileMd5(texPath)
-                            targetPathMd5 = getFileMd5(targetPath)
-                            #print '%s: %s' % (latestPath, latestMd5)
-                            #print '%s: %s' % (texPath, fileMd5)
-                            if texPathMd5 != targetPathMd5:
-                                makeFolder(targetPath)
-                                copyFile(texPath, targetPath)
-                            
-                            if replaceOutput:
-                                targetPath = '%s/%s' % (replaceOutput, filename)
-                            #      ['file','fileNodes','path1','path2']    
-                            pathInfo.append([typ,fn,texPath,targetPath])
+                        filename = os.path.basename(texPath.replace('\\','/'))
+                        targetPath = '%s/%s' % (output, filename)
+                        
+                        if not srcPaths.has_key(targetPath):
+                            srcPaths[targetPath] = []
+                            jobs.append((targetPath, srcPaths[targetPath]))
+                        srcPaths[targetPath].append(texPath)
                         
+                        items.append([typ,fn,texPath,filename])
+            
+            # Hash and copy files
+            func = lambda job: _exportTextures(job, algorithm=algorithm,
+                                               store=store, linkMode=linkMode)
+            if type(workers) == int and workers > 1 and len(jobs) > 1:
+                pool = ThreadPool(min(workers, len(jobs)))
+                try:
+                    temp = pool.map(func, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                temp = [func(job) for job in jobs]
+            
+            existing = set()
+            for i in temp:
+                existing.update(i)
+            
+            pathInfo = []
+            for typ,fn,texPath,filename in items:
+                if texPath in existing:
+                    texPath = texPath.replace('\\','/')
+                    if replaceOutput:
+                        targetPath = '%s/%s' % (replaceOutput, filename)
+                    else:
+                        targetPath = '%s/%s' % (output, filename)
+                    #      ['file','fileNodes','path1','path2']    
+                    pathInfo.append([typ,fn,texPath,targetPath])
+            
+            saveFileHashCache()
+            
             return pathInfo
         
 class replaceTexturePath(Action):
@@ -3933,6 +6172,28 @@ class replaceTexturePath(Action):
             sw.replaceTexturePaths2(pathInfo,replaceTo=replaceTo)
     
 
+class CleanTextureStore(Action):
+    '''
+    Removes the files in the texture store which are not used anymore.
+    roots are the folders to find symbolic links into the store,
+    set it to [] if the store is only used by hard links.
+    '''
+    
+    _defaultParms = {
+        'store': '',
+        'roots': None,
+        'dry_run': False,
+    }
+    
+    def run(self):
+        store = self.parm('store')
+        roots = self.parm('roots')
+        if roots in ('', None):
+            roots = None
+        
+        return collectTextureStoreGarbage(store, roots=roots,
+                                          dryRun=self.parm('dry_run'))
+
 class ExportSets(Action):
     
     _defaultParms = {
@@ -4022,13 +6283,11 @@ class ExportSceneLayout(Action):
             allSubsATypes = self.parm('all_subs_asset_types')
             
             # Get scene output assets
-            refs = sw.getReferenceObjects()
-            refs += sw.getGpuCaches()
-            refs += sw.getAssemblyReferences()
+            refs = getSceneInventory(self.engine(), sw).getAllReferences()
             
             alll = {}
             for i in refs:
-                info = self.engine().getInfoFromPath(i['path'], enableCache=True)
+                info = self.getInfoFromPath(i['path'])
                 asset = info.get('shot')
                 assetType = info.get('sequence')
                 
@@ -4150,6 +6409,150 @@ class GetRenderFiles(Action):
         
         return files
 
+def upsertVersion(database, project, filters, info):
+    '''Updates the version found by the filters, or creates a new one.'''
+    r = database.doesVersionExist(project, filters=filters)
+    if r:
+        database.updateVersionInfo(project, r['id'], info)
+    else:
+        database.createVersion(project, info)
+
+def upsertLatestVersion(database, project, filters, info):
+    '''Updates the latest version found by the filters, or creates a new one.'''
+    r = database.doesLatestVersionExist(project, filters=filters)
+    if r:
+        database.updateLatestVersionInfo(project, r['id'], info)
+    else:
+        database.createLatestVersion(project, info)
+
+class PublishTransaction(object):
+    '''
+    Collects the version, latest version and note writes of a publish,
+    and writes them to the database together at commit.
+    Upserts of the same version are merged, the last info wins.
+    
+    If the database has batchPublish, all writes are sent in one call:
+        database.batchPublish([
+            {'operation': 'create_version', 'project': 'abc', 'info': {...}},
+            {'operation': 'upsert_version', 'project': 'abc', 'filters': [...], 'info': {...}},
+            {'operation': 'upsert_latest_version', 'project': 'abc', 'filters': [...], 'info': {...}},
+            {'operation': 'create_note', 'project': 'abc', 'entity': 'shot_task', 'id': '...', 'text': '...'},
+        ])
+    otherwise they are written one by one like without the transaction.
+    
+    The writes are only sent at commit, reads of the same run, like
+    doesVersionExist, don't see them. The upserts look up the existing
+    versions at commit, so they see the writes committed before them.
+    '''
+    
+    def __init__(self):
+        self._operations = []
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._operations)
+    
+    def add(self, operation):
+        '''
+        Adds a write, the info is kept as a Record so later changes
+        of its items don't go in, the values are shared.
+        '''
+        info = operation.get('info')
+        if isinstance(info, dict):
+            operation = dict(operation, info=Record(info))
+        with self._lock:
+            if operation.has_key('filters'):
+                for op in self._operations:
+                    if op['operation'] == operation['operation'] and \
+                       op['project'] == operation['project'] and \
+                       op['filters'] == operation['filters']:
+                        op['info'] = operation['info']
+                        return
+            
+            self._operations.append(operation)
+    
+    def commit(self, database):
+        '''Writes all collected operations, returns the count of them.'''
+        with self._lock:
+            operations = self._operations
+            self._operations = []
+        
+        if not operations:
+            return 0
+        
+        # The transaction is closed after the commit, the writes
+        # not sent when it fails are dropped with it
+        if hasattr(database, 'batchPublish'):
+            database.batchPublish([_writableInfo(op) for op in operations])
+            return len(operations)
+        
+        for op in operations:
+            writeOperation(database, op)
+        
+        return len(operations)
+
+def _writableInfo(op):
+    '''Gets the operation with a dictionary info, the database may change it.'''
+    if isinstance(op.get('info'), Record):
+        op = dict(op, info=op['info'].copy())
+    return op
+
+def writeOperation(database, op):
+    '''Writes an operation of PublishTransaction to the database.'''
+    op = _writableInfo(op)
+    name = op['operation']
+    if name == 'create_version':
+        database.createVersion(op['project'], op['info'])
+    elif name == 'upsert_version':
+        upsertVersion(database, op['project'], op['filters'], op['info'])
+    elif name == 'upsert_latest_version':
+        upsertLatestVersion(database, op['project'], op['filters'], op['info'])
+    elif name == 'create_note':
+        database.createNote(op['project'], op['entity'], op['id'], op['text'])
+    else:
+        raise ValueError('Unknown publish operation: %s' % name)
+
+def getPublishTransaction(engine):
+    '''Gets the open PublishTransaction of the engine, None if there isn't one.'''
+    return _sessionCache(engine, 'publish_transaction').get('transaction')
+
+def _publishWrite(action, op):
+    '''Adds the operation to the open transaction, or writes it right now.'''
+    transaction = getPublishTransaction(action.engine())
+    if transaction is not None:
+        transaction.add(op)
+    else:
+        writeOperation(action.database(), op)
+
+class BeginPublishTransaction(Action):
+    '''
+    Opens a PublishTransaction for the engine, the following
+    MakePublishInfoFile, CreateLatestVersion and CreateVersionNote
+    actions only collect their writes until CommitPublishTransaction.
+    A transaction left by a failed run is dropped, its writes are
+    never sent.
+    '''
+    
+    def run(self):
+        temp = _sessionCache(self.engine(), 'publish_transaction')
+        temp['transaction'] = PublishTransaction()
+
+class CommitPublishTransaction(Action):
+    '''Writes the collected writes to the database and closes the transaction.'''
+    
+    progressText = 'Writing versions to database...'
+    
+    def run(self):
+        temp = _sessionCache(self.engine(), 'publish_transaction')
+        transaction = temp.get('transaction')
+        if transaction is None:
+            return 0
+        
+        try:
+            return transaction.commit(self.database())
+        finally:
+            temp.pop('transaction', None)
+
 class MakePublishInfoFile(Action):
     
     _defaultParms = {
@@ -4204,7 +6607,7 @@ class MakePublishInfoFile(Action):
         files1 = []
         for f in files:
             if f:
-                if type(f) == dict:
+                if isinstance(f, dict):
                     path = f.get('path')
                     
                     go = False
@@ -4215,8 +6618,8 @@ class MakePublishInfoFile(Action):
                         go = True
                     
                     if go:
-                        f['path'] = self.parsePath(path, root=folder)
-                        f['entity_type'] = 'published_file'
+                        f = dict(f, path=self.parsePath(path, root=folder),
+                                 entity_type='published_file')
                         files1.append(f)
                 
                 elif type(f) in (str, unicode):
@@ -4238,12 +6641,8 @@ class MakePublishInfoFile(Action):
         
         # Get info
         info = plcr.getEnvContext(self.task())
-        info = plcr.getTaskFromEnv(info)
-        info['task'] = info.get('code')
-        try:
-            del info['code']
-        except:
-            pass
+        info = Record(plcr.getTaskFromEnv(info))
+        info = info.without('code').with_(task=info.get('code'))
         
         info1 = {
             'entity_type': eType,
@@ -4262,22 +6661,27 @@ class MakePublishInfoFile(Action):
         if asset:
             info1['asset'] = asset
         
-        info.update(info1)
+        info = info.with_(info1)
         
         # Make the json file
         if self.parm('create_json_file'):
             makeFolder(infoPath)
-            txt = json.dumps(info, indent=4)
+            txt = json.dumps(info.copy(), indent=4)
             f = open(infoPath, 'w')
             f.write(txt)
             f.close()
         
         # Create a version on CGTeamwork
-        self.database().createVersion(self.project(), info)
+        op = {
+            'operation': 'create_version',
+            'project': self.project(),
+            'info': info
+        }
+        _publishWrite(self, op)
         
         # Create a latest version
         if self.parm('create_latest_version'):
-            latestInfo = info.copy()
+            latestInfo = info
             
             # Find existing version
             filterKeys = [
@@ -4295,26 +6699,19 @@ class MakePublishInfoFile(Action):
             #print 'filters:'
             #print filters
             
-            r = self.database().doesLatestVersionExist(self.project(), filters=filters)
-            
-            #print 'result:',r
-            
-            if r:
-                # Update the version
-                #print
-                #print 'versionInfo:'
-                #print latestInfo
-                
-                self.database().updateLatestVersionInfo(self.project(), r['id'], latestInfo)
-            
-            else:
-                # Create a new one
-                self.database().createLatestVersion(self.project(), latestInfo)
+            # Update the version or create a new one
+            op = {
+                'operation': 'upsert_latest_version',
+                'project': self.project(),
+                'filters': filters,
+                'info': latestInfo
+            }
+            _publishWrite(self, op)
         
         # Make a version json file
         vnPath = ''
         
-        return info
+        return info.copy()
 
 class CreateLatestVersion(Action):
     
@@ -4367,8 +6764,8 @@ class CreateLatestVersion(Action):
         files1 = []
         for f in files:
             if f:
-                if type(f) == dict:
-                    f['path'] = self.parsePath(f.get('path'), root=folder)
+                if isinstance(f, dict):
+                    f = dict(f, path=self.parsePath(f.get('path'), root=folder))
                     files1.append(f)
                 
                 elif type(f) in (str, unicode):
@@ -4381,12 +6778,8 @@ class CreateLatestVersion(Action):
                     files1.append(d)
         
         # Get info
-        info = copy.deepcopy(self.task())
-        info['task'] = info.get('code')
-        try:
-            del info['code']
-        except:
-            pass
+        info = self.taskRecord()
+        info = info.without('code').with_(task=info.get('code'))
         
         #print
         #print 'task:',
@@ -4413,7 +6806,7 @@ class CreateLatestVersion(Action):
         #print 'version_info1:'
         #print info
         
-        info.update(info1)
+        info = info.with_(info1)
         
         #print
         #print 'version_info:'
@@ -4439,23 +6832,16 @@ class CreateLatestVersion(Action):
         #print 'filters:'
         #print filters
         
-        r = self.database().doesVersionExist(self.project(), filters=filters)
-        
-        #print 'result:',r
-        
-        if r:
-            # Update the version
-            #print
-            #print 'versionInfo:'
-            #print info
-            
-            self.database().updateVersionInfo(self.project(), r['id'], info)
-        
-        else:
-            # Create a new one
-            self.database().createVersion(self.project(), info)
+        # Update the version or create a new one
+        op = {
+            'operation': 'upsert_version',
+            'project': self.project(),
+            'filters': filters,
+            'info': info
+        }
+        _publishWrite(self, op)
         
-        return info
+        return info.copy()
 
 class UpdateVersionInfo(Action):
     
@@ -4511,7 +6897,14 @@ class CreateVersionNote(Action):
         
         #text = '<br>'.join(lines)
         
-        self.database().createNote(project, entity, taskId, text)
+        op = {
+            'operation': 'create_note',
+            'project': project,
+            'entity': entity,
+            'id': taskId,
+            'text': text
+        }
+        _publishWrite(self, op)
 
 class MakePreviewInfoFile(Action):
     
@@ -4617,6 +7010,63 @@ class Print(Action):
         else:
             print i
 
+class DatabaseCache(Action):
+    '''
+    Turns on the database cache of the engine, put it at the start of
+    the template. The cached results are dropped each time it runs,
+    so each run reads the database again.
+        enabled: False to read the database directly
+        ttl: seconds to keep a result
+        max_size: count of results to keep
+    '''
+    
+    _defaultParms = {
+        'enabled': True,
+        'ttl': 300,
+        'max_size': 1024,
+    }
+    
+    def run(self):
+        settings = _sessionCache(self.engine(), 'database_cache_settings')
+        settings['enabled'] = self.parm('enabled')
+        settings['ttl'] = self.parm('ttl')
+        settings['max_size'] = self.parm('max_size')
+        
+        # Made again with the new settings and no results of the last run
+        _sessionCache(self.engine(), 'database_cache').clear()
+
+class BeginSceneInventory(Action):
+    '''
+    Starts a scene run, the following actions share one SceneInventory
+    until EndSceneInventory. Put it at the start of the template.
+    '''
+    
+    def run(self):
+        beginSceneInventory(self.engine())
+
+class EndSceneInventory(Action):
+    '''Ends the scene run, put it at the end of the template.'''
+    
+    def run(self):
+        endSceneInventory(self.engine())
+
+class PrintDatabaseCacheStats(Action):
+    '''Prints the stats of the database cache, put it at the end of the template.'''
+    
+    def run(self):
+        proxies = _sessionCache(self.engine(), 'database_cache')
+        result = [proxy.stats() for proxy in proxies.values()]
+        
+        for stats in result:
+            print
+            print 'Database cache: %s hits, %s misses, hit ratio %.1f%%, %s invalidations' % \
+                  (stats['hits'], stats['misses'], stats['hit_ratio']*100, stats['invalidations'])
+            for name in sorted(stats['methods'].keys()):
+                counts = stats['methods'][name]
+                print '    %s: %s hits, %s misses' % (name, counts['hits'], counts['misses'])
+        
+        return result
+
 class SaveToFile(Action):
     
     _defaultParms = {
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of fllb.query with different numbers of workers.
+
+A synthetic tree of image sequences is made in a temporary folder,
+or an existing folder is given, then it's queried with 1, 4 and 16 workers:
+    python benchmark_query.py
+    python benchmark_query.py //nas/project/shots 1,4,16
+
+On a local disk the stat calls are cached by the system, the workers
+make little difference. Try it on a network share to see the gain.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import fllb
+
+def makeTree(root, dirs=20, depth=2, frames=200):
+    '''Makes dirs folders in each level, each folder has one image sequence.'''
+    level = [root]
+    for i in range(depth):
+        subs = []
+        for d in level:
+            for j in range(dirs):
+                sub = '%s/dir%02d' % (d, j)
+                os.makedirs(sub)
+                for f in range(1, frames+1):
+                    open('%s/img.%04d.exr' % (sub, f), 'w').close()
+                subs.append(sub)
+        level = subs
+
+def benchmark(root, workers=(1, 4, 16), repeat=3):
+    for w in workers:
+        costs = []
+        for i in range(repeat):
+            start = time.time()
+            result = fllb.query(root, getAllSubs=True, workers=w)
+            costs.append(time.time() - start)
+        
+        print 'workers: %-3s records: %-6s best: %.3fs' % (w, len(result), min(costs))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        root = sys.argv[1].replace('\\','/')
+        workers = (1, 4, 16)
+        if len(sys.argv) > 2:
+            workers = [int(w) for w in sys.argv[2].split(',')]
+        benchmark(root, workers)
+    
+    else:
+        root = tempfile.mkdtemp().replace('\\','/')
+        try:
+            print 'making tree: %s' % root
+            makeTree(root, dirs=10, depth=2, frames=100)
+            benchmark(root)
+        finally:
+            shutil.rmtree(root)
@@ -15,7 +15,25 @@ import re
 import math
 import glob
 import time
+import stat
 import shutil
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
 def getHumanReadableSize(size):
     '''
     Gets a human readable format like this:
@@ -39,50 +57,191 @@ def secondTimeToString(second):
     t = time.localtime(second)
     return time.strftime('%Y-%m-%d %H:%M', t)
 
-def framesToFrameRange(frames):
+def _toArray(frames):
+    return _numpy.asarray(frames, dtype=_numpy.int64)
+
+class FrameSet(object):
     '''
-    Gets frame range from frame numbers.
-    The frame numbers must be all positive numbers.
+    A sorted set of frame numbers, the frame numbers must be all
+    positive integers. NumPy is used for the calculation if it's installed.
+    
     Example:
-        frames: [1,2,3,4,60,8,9,10,56,57,58]
-        return: '1-4,8-10,56-58,60'
+        fs = FrameSet([1,2,3,4,60,8,9,10,56,57,58])
+        str(fs): '1-4,8-10,56-58,60'
+        fs.missing(): FrameSet('5-7,11-55,59')
+        FrameSet.fromRange('1-4') | FrameSet([5]): FrameSet('1-5')
+        FrameSet.fromRange('1-10') - FrameSet([5]): FrameSet('1-4,6-10')
     '''
-    temp = []
     
-    # Remove duplicated items and sort the list
-    frames = sorted(list(set(frames)))
-    
-    # Collect frames in ranges
-    for i in range(len(frames)):
-        f = frames[i]
-                
-        if type(f) == int:
-            if f < 0:
+    def __init__(self, frames=(), validate=True):
+        if isinstance(frames, FrameSet):
+            self._frames = frames._frames
+            return
+        
+        if _numpy != None and isinstance(frames, _numpy.ndarray):
+            frames = frames.tolist()
+        
+        frames = sorted(set(frames))
+        
+        if validate:
+            # Sorted frames, only need to check the first one for negative numbers
+            for f in frames:
+                if type(f) not in (int, long):
+                    raise Exception('frame number must be an integer value')
+            if frames and frames[0] < 0:
                 raise Exception('frame number must be a positive number')
-        else:
-            raise Exception('frame number must be an integer value')
         
-        if i == 0:
-            temp.append([f])
-            continue
+        self._frames = frames
+    
+    @classmethod
+    def fromRange(cls, frameRange):
+        '''Gets a FrameSet from frame range string like 1-4,8-10,56-58,60.'''
+        return cls(frameRangeToFrames(frameRange), validate=False)
+    
+    def __len__(self):
+        return len(self._frames)
+    
+    def __iter__(self):
+        return iter(self._frames)
+    
+    def __contains__(self, frame):
+        import bisect
+        i = bisect.bisect_left(self._frames, frame)
+        return i < len(self._frames) and self._frames[i] == frame
+    
+    def __eq__(self, other):
+        return isinstance(other, FrameSet) and self._frames == other._frames
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __str__(self):
+        return self.toRange()
+    
+    def __repr__(self):
+        return "FrameSet('%s')" % self.toRange()
+    
+    def __or__(self, other):
+        return self.union(other)
+    
+    def __sub__(self, other):
+        return self.difference(other)
+    
+    def __and__(self, other):
+        return self.intersection(other)
+    
+    def first(self):
+        if self._frames:
+            return self._frames[0]
+    
+    def last(self):
+        if self._frames:
+            return self._frames[-1]
+    
+    def toList(self):
+        return list(self._frames)
+    
+    def ranges(self):
+        '''
+        Gets the continuous ranges of the frames.
+        Example:
+            frames: [1,2,3,4,8,9,10,60]
+            return: [(1,4), (8,10), (60,60)]
+        '''
+        frames = self._frames
+        if not frames:
+            return []
         
-        else:
-            if f-frames[(i-1)] == 1:
-                temp[-1].append(f)
-            
+        if _numpy != None:
+            a = _toArray(frames)
+            breaks = _numpy.nonzero(_numpy.diff(a) != 1)[0]
+            starts = a[_numpy.concatenate(([0], breaks+1))].tolist()
+            ends = a[_numpy.concatenate((breaks, [len(a)-1]))].tolist()
+            return zip(starts, ends)
+        
+        result = []
+        start = previous = frames[0]
+        for f in frames[1:]:
+            if f - previous != 1:
+                result.append((start, previous))
+                start = f
+            previous = f
+        result.append((start, previous))
+        
+        return result
+    
+    def toRange(self):
+        '''Gets frame range string like 1-4,8-10,56-58,60.'''
+        lst = []
+        for first,last in self.ranges():
+            if first == last:
+                lst.append('%s' % first)
             else:
-                temp.append([f])
+                lst.append('%s-%s' % (first, last))
+        
+        return ','.join(lst)
     
-    # Get frame range string
-    lst = []
-    for i in temp:
-        if len(i) == 1:
-            unit = '%s' % i[0]
-        else:
-            unit = '%s-%s' % (i[0], i[-1])
-        lst.append(unit)
+    def missing(self):
+        '''Gets the frames between the first and last frame which are not in the set.'''
+        frames = self._frames
+        if not frames:
+            return FrameSet()
+        
+        if _numpy != None:
+            a = _toArray(frames)
+            full = _numpy.arange(frames[0], frames[-1]+1)
+            missing = _numpy.setdiff1d(full, a, assume_unique=True)
+            return self._new(missing.tolist())
+        
+        result = []
+        previous = frames[0]
+        for f in frames[1:]:
+            if f - previous > 1:
+                result.extend(range(previous+1, f))
+            previous = f
+        
+        return self._new(result)
+    
+    def union(self, other):
+        other = FrameSet(other)
+        if _numpy != None:
+            r = _numpy.union1d(_toArray(self._frames), _toArray(other._frames))
+            return self._new(r.tolist())
+        return FrameSet(self._frames + other._frames, validate=False)
+    
+    def difference(self, other):
+        other = FrameSet(other)
+        if _numpy != None:
+            r = _numpy.setdiff1d(_toArray(self._frames), _toArray(other._frames),
+                                  assume_unique=True)
+            return self._new(r.tolist())
+        temp = set(other._frames)
+        return self._new([f for f in self._frames if f not in temp])
     
-    return ','.join(lst)
+    def intersection(self, other):
+        other = FrameSet(other)
+        if _numpy != None:
+            r = _numpy.intersect1d(_toArray(self._frames), _toArray(other._frames),
+                                    assume_unique=True)
+            return self._new(r.tolist())
+        temp = set(other._frames)
+        return self._new([f for f in self._frames if f in temp])
+    
+    def _new(self, sortedFrames):
+        # Frames are already sorted and unique
+        fs = FrameSet()
+        fs._frames = sortedFrames
+        return fs
+
+def framesToFrameRange(frames):
+    '''
+    Gets frame range from frame numbers.
+    The frame numbers must be all positive numbers.
+    Example:
+        frames: [1,2,3,4,60,8,9,10,56,57,58]
+        return: '1-4,8-10,56-58,60'
+    '''
+    return FrameSet(frames).toRange()
 
 def frameRangeToFrames(frameRange):
     '''
@@ -138,18 +297,255 @@ def wildcardToRePattern(string):
     else:
         return string
 
+# A file or folder with the stat info
+Entry = collections.namedtuple('Entry', 'name path isdir size mtime ctime')
+
+def statEntry(path):
+    '''
+    Gets the Entry of the path with one stat call.
+    Returns None if the path doesn't exist.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    
+    return Entry(os.path.basename(path), path, stat.S_ISDIR(st.st_mode),
+                 st.st_size, st.st_mtime, st.st_ctime)
+
+_statChunkSize = 64
+
+def statEntries(paths, pool=None):
+    '''
+    Gets the Entries of the paths, missing paths are skipped.
+    If a thread pool is given, the stat calls are shared by its workers,
+    which hides the latency of network filesystems.
+    '''
+    if pool is None:
+        entries = [statEntry(p) for p in paths]
+    else:
+        chunkSize = max(1, min(_statChunkSize, len(paths) // (pool._processes * 4)))
+        entries = pool.map(statEntry, paths, chunkSize)
+    return [e for e in entries if e]
+
+def listDirectory(dir, pool=None):
+    '''
+    Gets the entries in the dir sorted by name, each entry is stat'ed
+    only once. Broken links are skipped like os.path.exists does.
+    If a thread pool is given, the entries are stat'ed by its workers.
+    '''
+    result = []
+    # On Windows the stat info comes with the directory listing,
+    # so the pool is only used when each entry needs a stat call
+    if pool and not (_scandir and os.name == 'nt'):
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            return result
+        
+        paths = ['%s/%s' % (dir, name) for name in names]
+        result = statEntries(paths, pool)
+    
+    elif _scandir:
+        try:
+            items = _scandir(dir)
+        except OSError:
+            return result
+        
+        for item in items:
+            try:
+                # On Windows the stat info comes with the directory listing
+                st = item.stat()
+            except OSError:
+                continue
+            
+            path = '%s/%s' % (dir, item.name)
+            e = Entry(item.name, path, stat.S_ISDIR(st.st_mode),
+                      st.st_size, st.st_mtime, st.st_ctime)
+            result.append(e)
+    
+    else:
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            return result
+        
+        for name in names:
+            e = statEntry('%s/%s' % (dir, name))
+            if e:
+                result.append(e)
+    
+    result.sort(key=lambda e: e.name)
+    return result
+
+def walkDirectory(dir, pool=None, listFunc=listDirectory):
+    '''
+    Walks the dir from top to bottom without recursion,
+    sub directories are walked in the order of the names.
+    Yields the directory and its entries:
+        ('/abc', [Entry(...), ...])
+    If a thread pool is given, the entries of each directory
+    are stat'ed by its workers.
+    '''
+    entries = listFunc(dir, pool)
+    yield dir,entries
+    
+    stack = [iter(entries)]
+    while stack:
+        for e in stack[-1]:
+            if e.isdir:
+                subEntries = listFunc(e.path, pool)
+                yield e.path,subEntries
+                stack.append(iter(subEntries))
+                break
+        else:
+            stack.pop()
+
+def _walkDirectoryParallel(dir, pool, listFunc=listDirectory):
+    '''
+    Lists the dir level by level, the directories of one level are
+    listed by the workers of the pool at the same time.
+    The listings are kept until the whole tree is scanned, then yielded
+    in the same order as walkDirectory does.
+    '''
+    listings = {dir: listFunc(dir, pool)}
+    level = [dir]
+    while level:
+        subs = [e.path for d in level for e in listings[d] if e.isdir]
+        if len(subs) == 1:
+            # Only one directory, share its stat calls instead
+            listings[subs[0]] = listFunc(subs[0], pool)
+        elif subs:
+            for d,entries in zip(subs, pool.map(listFunc, subs, 1)):
+                listings[d] = entries
+        level = subs
+    
+    yield dir,listings[dir]
+    
+    stack = [iter(listings[dir])]
+    while stack:
+        for e in stack[-1]:
+            if e.isdir:
+                subEntries = listings.pop(e.path)
+                yield e.path,subEntries
+                stack.append(iter(subEntries))
+                break
+        else:
+            stack.pop()
+
+class Snapshot(list):
+    '''
+    The entries of a directory with the stamp of the directory,
+    records keeps the collected sequences by the query filters.
+    '''
+    def __init__(self, entries=(), stamp=None):
+        list.__init__(self, entries)
+        self.stamp = stamp
+        self.records = {}
+
+class SnapshotCache(object):
+    '''
+    Keeps the latest snapshots of the directories, the least recently
+    used one is evicted if there are more than maxSize directories.
+    A snapshot is used only when the mtime and inode of the directory
+    are the same, adding, removing or renaming files changes the mtime.
+    The sub directories are stat'ed again, their times are not stamped
+    on the parent. Rewriting a file in place changes nothing,
+    clear the cache for that.
+    '''
+    # A directory modified in the last seconds may still be changed
+    # within the same mtime, so it's not cached
+    racyTime = 2.0
+    
+    def __init__(self, maxSize=1000):
+        self.maxSize = maxSize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def listDirectory(self, dir, pool=None):
+        '''Gets the snapshot of the dir, the dir is listed again if it's changed.'''
+        try:
+            st = os.stat(dir)
+        except OSError:
+            return Snapshot()
+        
+        stamp = (st.st_mtime, st.st_ino)
+        with self._lock:
+            snapshot = self._data.pop(dir, None)
+        
+        if snapshot is not None and snapshot.stamp == stamp and self._isFresh(snapshot):
+            with self._lock:
+                self._data[dir] = snapshot
+                self.hits += 1
+            return snapshot
+        
+        with self._lock:
+            self.misses += 1
+        
+        snapshot = Snapshot(listDirectory(dir, pool), stamp)
+        if time.time() - st.st_mtime > self.racyTime:
+            with self._lock:
+                self._data[dir] = snapshot
+                while len(self._data) > self.maxSize:
+                    self._data.popitem(last=False)
+        return snapshot
+    
+    def _isFresh(self, snapshot):
+        for e in snapshot:
+            if e.isdir and statEntry(e.path) != e:
+                return False
+        return True
+    
+    def setMaxSize(self, maxSize):
+        with self._lock:
+            self.maxSize = maxSize
+            while len(self._data) > self.maxSize:
+                self._data.popitem(last=False)
+    
+    def clear(self, dir=None):
+        '''Clears the snapshot of the dir and its sub directories, or all snapshots.'''
+        with self._lock:
+            if dir is None:
+                self._data.clear()
+            else:
+                dir = dir.replace('\\','/').rstrip('/')
+                for d in self._data.keys():
+                    if d == dir or d.startswith(dir + '/'):
+                        del self._data[d]
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_size': self.maxSize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / total if total else 0.0,
+        }
+
+_snapshotCache = SnapshotCache()
+
+def setQueryCacheSize(maxSize):
+    '''Sets how many directories are kept by the query cache.'''
+    _snapshotCache.setMaxSize(maxSize)
+
+def clearQueryCache(dir=None):
+    '''Clears the query cache of the dir and its sub directories, or the whole cache.'''
+    _snapshotCache.clear(dir)
+
+def getQueryCacheStats():
+    '''Gets the size, hits, misses and hit_ratio of the query cache.'''
+    return _snapshotCache.stats()
+
 def getAllSubDirs(dir):
     '''Get all sub directories in the dir.'''
     dirs = []
-    def getSubs(d):
-        if os.path.isdir(d):
-            files = os.listdir(d)
-            for f in sorted(files):
-                fPath = '%s/%s' % (d, f)
-                if os.path.isdir(fPath):
-                    dirs.append(fPath)
-                    getSubs(fPath)
-    getSubs(dir)
+    if os.path.isdir(dir):
+        for d,entries in walkDirectory(dir):
+            dirs.append(d)
+        dirs = dirs[1:]
     return dirs
 
 def getSequencePattern(pattern):
@@ -275,8 +671,267 @@ def parseSequence(path):
     }
     return result
 
+_digitsPattern = re.compile('\\d+')
+def _collectEntries(data, entries, exts, unSeqExts, keyword, sequence, pat,
+                    hideHiddenFiles, compact=False):
+    '''
+    Collects the entries into the data by sequence.
+    In compact mode, only frame numbers, total size and latest times
+    are kept instead of the lists of each frame.
+    '''
+    for e in entries:
+        f = e.name
+        fPath = e.path
+        path = os.path.dirname(fPath)
+        
+        if hideHiddenFiles:
+            if f.startswith('.') or f.endswith('~') or f == 'Thumbs.db':
+                continue
+        
+        #print 'keyword: %s' % keyword
+        gogo = False
+        if type(keyword) in (str, unicode):
+            if keyword in f:
+                gogo = True
+        else:
+            if keyword.findall(f):
+                gogo = True
+        
+        if not gogo:
+            continue
+        
+        # if f is a directory, we take the extension as dir
+        if e.isdir:
+            ext = '/'
+        else:
+            ext = os.path.splitext(f)[1][1:]
+        
+        # if filter is empty string, just go forward
+        # else, if extension is in the filter, go forward
+        if exts:
+            if ext not in exts:
+                continue
+        
+        size = e.size
+        
+        # do not collect as sequence for directory
+        if e.isdir == False and sequence and ext not in unSeqExts:
+            # try to find the last group of continuous digits
+            continuousDigitsList = pat.findall(f)
+            #print continuousDigitsList
+            try:
+                continuousDigits = _digitsPattern.findall(continuousDigitsList[-1])[0]
+                fBaseName = f.split(continuousDigitsList[-1])[0]
+            except:
+                continuousDigits = ''
+                fBaseName = os.path.splitext(f)[0]
+            
+            # replace last group of continuousDigits with same number of # as the format
+            digitStyle = len(continuousDigits)*'#'
+            format = f[::-1].replace(continuousDigits[::-1], digitStyle, 1)[::-1]
+        else:
+            fBaseName = os.path.splitext(f)[0]
+            continuousDigits = 0
+            digitStyle = ''
+            format = f
+        
+        key = '%s/%s' % (path, format)
+        if data.has_key(key) == False:
+            data[key] = {
+                'basename': fBaseName,
+                'directory': path, 
+                'digits': digitStyle,
+                'padding': digitStyle,
+                'extension': ext,
+                'frames': [],
+                'missings': [],
+                'missing': '', 
+                'real_size': size,
+                }
+            if compact:
+                data[key]['latest_modified_time'] = e.mtime
+                data[key]['latest_created_time'] = e.ctime
+            else:
+                data[key]['filenames'] = []
+                data[key]['paths'] = []
+                data[key]['modified_times'] = []
+                data[key]['created_times'] = []
+        else:
+            data[key]['real_size'] += size
+        
+        #data[key]['digits'].append(continuousDigits)
+        if continuousDigits == '':
+            continuousDigits = 0
+        else:
+            continuousDigits = int(continuousDigits)
+        
+        data[key]['frames'].append(continuousDigits)
+        if compact:
+            data[key]['latest_modified_time'] = max(data[key]['latest_modified_time'], e.mtime)
+            data[key]['latest_created_time'] = max(data[key]['latest_created_time'], e.ctime)
+        else:
+            data[key]['filenames'].append(f)
+            data[key]['paths'].append(fPath)
+            data[key]['modified_times'].append(e.mtime)
+            data[key]['created_times'].append(e.ctime)
+
+def _finalizeRecord(key, record):
+    '''Fills the sequence info of the collected record.'''
+    baseName = os.path.basename(key)
+    if record['digits']:
+        record['type'] = 'seq'
+        frames = FrameSet(record['frames'])
+        record['frame_range'] = frames.toRange()
+        record['first_frame'] = frames.first()
+        record['last_frame'] = frames.last()
+        record['filename'] = baseName
+        record['name'] = baseName
+        record['code'] = baseName
+        record['full_name'] = '%s %s' % (baseName, record['frame_range'])
+        record['path'] = '%s/%s' % (record['directory'], baseName)
+        record['full_path'] = '%s %s' % (record['path'], record['frame_range'])
+        
+        # find missing frames
+        record['missings'] = frames.missing().toList()
+        
+        temp = [str(i) for i in record['missings']]
+        if temp:
+            record['missing'] = '%s Missing: %s' % (len(temp), ','.join(temp))
+    
+    else:
+        if record['extension'] == '/':
+            record['type'] = 'dir'
+        else:
+            record['type'] = 'single'
+        
+        record['frame_range'] = ''
+        record['first_frame'] = 1
+        record['last_frame'] = 1
+        record['name'] = baseName
+        record['full_name'] = record['name']
+        record['path'] = '%s/%s' % (record['directory'], baseName)
+        record['full_path'] = record['path']
+    
+    record['size'] = getHumanReadableSize(record['real_size'])
+    
+    if record.has_key('modified_times'):
+        latestMTime = max(record['modified_times'])
+        latestCTime = max(record['created_times'])
+    else:
+        latestMTime = record['latest_modified_time']
+        latestCTime = record['latest_created_time']
+    
+    record['modified_time'] = secondTimeToString(latestMTime)
+    record['created_time'] = secondTimeToString(latestCTime)
+    
+    return record
+
+def _parseQueryArgs(path, exts, unSeqExts, keyword, sequencePattern):
+    '''Gets the paths and filters for query and iquery.'''
+    if type(exts) == list:
+        pass
+    else:
+        exts = exts.replace(' ','').replace('.','')
+        if exts:
+            exts = exts.split(',')
+        else:
+            exts = []
+    
+    if type(unSeqExts) == list:
+        pass
+    else:
+        unSeqExts = unSeqExts.replace(' ','').replace('.','')
+        if unSeqExts:
+            unSeqExts = unSeqExts.split(',')
+        else:
+            unSeqExts = []
+    
+    #if exts.replace('*','') == '':
+    #    exts = ''
+    
+    if type(path) == list:
+        ps = path[:]
+    else:
+        ps = [path]
+    
+    # check the path to see whether there is wildcard in it
+    paths = []
+    for p in ps:
+        if p:
+            p = p.replace('\\', '/')
+            if hasWildcard(p):
+                paths.extend(glob.glob(p))
+            else:
+                paths.append(p)
+    
+    #print 'file_lib.query.paths:',paths
+    
+    # turn wildcard to a regular pattern
+    keyword = wildcardToRePattern(keyword)
+    
+    pat = re.compile(getSequencePattern(sequencePattern))
+    
+    return sorted(paths),exts,unSeqExts,keyword,pat
+
+def _iterPathEntries(path, getAllSubs=False, pool=None, levels=False, useCache=False):
+    '''
+    Yields the directories and entries of the path,
+    the path can be a directory or a file path with frame range.
+    levels: list the sub directories level by level with the pool,
+        faster but the whole tree is scanned before the first yield.
+    useCache: the entries of directories are Snapshots from the cache.
+    '''
+    path = path.replace('\\','/')
+    
+    #print
+    #print 'file_lib.query.path: %s' % path
+    if os.path.isdir(path):
+        listFunc = _snapshotCache.listDirectory if useCache else listDirectory
+        if getAllSubs:
+            walk = _walkDirectoryParallel if pool and levels else walkDirectory
+            for d,entries in walk(path, pool, listFunc):
+                yield d,entries
+        else:
+            yield path,listFunc(path, pool)
+    
+    else:
+        entries = statEntries(pathToFrames(path), pool)
+        yield os.path.dirname(path),entries
+
+def _copyRecord(record):
+    '''Copies the record and its lists, so the cached one is never changed.'''
+    result = dict(record)
+    for k,v in result.items():
+        if type(v) == list:
+            result[k] = v[:]
+    return result
+
+def _collectSnapshot(data, entries, exts, unSeqExts, keyword, sequence, pat,
+                     hideHiddenFiles, compact=False):
+    '''
+    Collects the entries into the data like _collectEntries, the sequences
+    of a Snapshot are collected once for each filter and reused.
+    '''
+    if not isinstance(entries, Snapshot) or entries.stamp is None:
+        _collectEntries(data, entries, exts, unSeqExts, keyword,
+                        sequence, pat, hideHiddenFiles, compact=compact)
+        return
+    
+    filterKey = (tuple(exts), tuple(unSeqExts), getattr(keyword, 'pattern', keyword),
+                 bool(sequence), pat.pattern, bool(hideHiddenFiles), bool(compact))
+    records = entries.records.get(filterKey)
+    if records is None:
+        records = {}
+        _collectEntries(records, entries, exts, unSeqExts, keyword,
+                        sequence, pat, hideHiddenFiles, compact=compact)
+        entries.records[filterKey] = records
+    
+    for key,record in records.items():
+        data[key] = _copyRecord(record)
+
 def query(path, exts='', unSeqExts='', keyword='', sequence=True, sequencePattern='.#.',
-          getAllSubs=False, hideHiddenFiles=True):
+          getAllSubs=False, hideHiddenFiles=True, compact=False, workers=0,
+          useCache=False):
     '''
     Gets files by sequence with given argument into a dictionary.
     Directories will not be collected as sequence.
@@ -300,6 +955,15 @@ def query(path, exts='', unSeqExts='', keyword='', sequence=True, sequencePatter
             True: get all sub files of the dir, 
             False: just get files in dir
         hideHiddenFiles: default is True
+        compact: don't keep filenames, paths, modified_times and created_times
+            of each frame, keep latest_modified_time and latest_created_time
+        workers: number of threads to stat the files, 0 means no threads.
+            Stat calls are slow on network filesystems like NFS and SMB,
+            several workers hide the latency, the result is the same.
+        useCache: reuse the sequences of the directories which are not
+            changed since the last query, see SnapshotCache.
+            The cache is shared by all queries, use clearQueryCache
+            after files are rewritten in place.
     
     The final data is like this:
     [
@@ -329,252 +993,216 @@ def query(path, exts='', unSeqExts='', keyword='', sequence=True, sequencePatter
         },
     ]
     '''
-    if type(exts) == list:
-        pass
-    else:
-        exts = exts.replace(' ','').replace('.','')
-        if exts:
-            exts = exts.split(',')
-        else:
-            exts = []
+    paths,exts,unSeqExts,keyword,pat = _parseQueryArgs(path, exts, unSeqExts,
+                                                        keyword, sequencePattern)
     
-    if type(unSeqExts) == list:
-        pass
-    else:
-        unSeqExts = unSeqExts.replace(' ','').replace('.','')
-        if unSeqExts:
-            unSeqExts = unSeqExts.split(',')
-        else:
-            unSeqExts = []
+    pool = ThreadPool(workers) if workers > 1 else None
+    data = {}
+    try:
+        for path in paths:
+            for d,entries in _iterPathEntries(path, getAllSubs=getAllSubs, pool=pool,
+                                              levels=True, useCache=useCache):
+                _collectSnapshot(data, entries, exts, unSeqExts, keyword,
+                                 sequence, pat, hideHiddenFiles, compact=compact)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
     
-    #if exts.replace('*','') == '':
-    #    exts = ''
+    result = []
+    for key in sorted(data.keys()):
+        # Only get files if getAllSubs is True
+        if getAllSubs:
+            if data[key]['extension'] == '/':
+                continue
+        
+        result.append(_finalizeRecord(key, data[key]))
     
-    if type(path) == list:
-        ps = path[:]
-    else:
-        ps = [path]
+    return result
+
+def iquery(path, exts='', unSeqExts='', keyword='', sequence=True, sequencePattern='.#.',
+           getAllSubs=False, hideHiddenFiles=True, compact=False, workers=0,
+           useCache=False):
+    '''
+    A generator version of query, the arguments are the same as query.
+    Sequences are yielded as soon as their directory is scanned,
+    so the records come by directory, sorted by path in each directory.
+    Use compact mode to keep memory flat when scanning a big tree.
+    With workers, the stat calls of each directory are shared by the
+    threads, the directories are still yielded one by one.
+    '''
+    paths,exts,unSeqExts,keyword,pat = _parseQueryArgs(path, exts, unSeqExts,
+                                                        keyword, sequencePattern)
     
-    # check the path to see whether there is wildcard in it
-    paths = []
-    for p in ps:
-        if p:
-            p = p.replace('\\', '/')
-            if hasWildcard(p):
-                paths.extend(glob.glob(p))
-            else:
-                paths.append(p)
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        for path in paths:
+            for d,entries in _iterPathEntries(path, getAllSubs=getAllSubs, pool=pool,
+                                              useCache=useCache):
+                data = {}
+                _collectSnapshot(data, entries, exts, unSeqExts, keyword,
+                                 sequence, pat, hideHiddenFiles, compact=compact)
+                
+                for key in sorted(data.keys()):
+                    # Only get files if getAllSubs is True
+                    if getAllSubs:
+                        if data[key]['extension'] == '/':
+                            continue
+                    
+                    yield _finalizeRecord(key, data[key])
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+# Buffer of the file copy
+_copyBufferSize = 1024 * 1024
+def isSameFile(srcPath, dstPath, srcStat=None):
+    '''
+    Checks whether the target file has the same size and modified time
+    as the source file, copyFileData keeps the modified time.
+    Times are compared in seconds since some filesystems drop the rest.
+    '''
+    try:
+        dst = os.stat(dstPath)
+        src = srcStat or os.stat(srcPath)
+    except OSError:
+        return False
     
-    if getAllSubs:
-        allSubs = []
-        for p in paths:
-            allSubs.extend(getAllSubDirs(p))
-        
-        paths.extend(allSubs)
+    return dst.st_size == src.st_size and int(dst.st_mtime) == int(src.st_mtime)
+
+def copyFileData(srcPath, dstPath, srcStat=None):
+    '''
+    Copies the source file to the target path safely.
+    The data is written to dstPath.part first, then renamed to dstPath,
+    so dstPath is either the old one or the whole new one.
+    The modified time of the source file is kept.
+    '''
+    src = srcStat or os.stat(srcPath)
+    tempPath = dstPath + '.part'
+    with open(srcPath, 'rb') as fsrc:
+        with open(tempPath, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, _copyBufferSize)
     
-    #print 'file_lib.query.paths:',paths
+    os.utime(tempPath, (src.st_atime, src.st_mtime))
     
-    # turn wildcard to a regular pattern
-    keyword = wildcardToRePattern(keyword)
+    # Windows can't rename to an existing file
+    if os.name == 'nt' and os.path.exists(dstPath):
+        os.remove(dstPath)
+    os.rename(tempPath, dstPath)
+
+def isSamePath(srcPath, dstPath):
+    '''Checks whether the two paths are the same file.'''
+    if hasattr(os.path, 'samefile'):
+        try:
+            return os.path.samefile(srcPath, dstPath)
+        except OSError:
+            return False
     
-    data = {}
+    # Windows with Python 2 doesn't have samefile
+    norm = lambda p: os.path.normcase(os.path.abspath(p))
+    return norm(srcPath) == norm(dstPath)
+
+def transferFile(srcPath, dstPath, move=False, skipSame=True):
+    '''
+    Copies or moves the source file to the target path.
+    Returns the status:
+        missing: the source file doesn't exist
+        skipped: the target file is the same, see isSameFile,
+            or the target path is the source file itself
+        copied: the file is copied
+        moved: the file is moved
+    '''
+    try:
+        src = os.stat(srcPath)
+    except OSError:
+        return 'missing'
     
-    pat = getSequencePattern(sequencePattern)
+    # Nothing to do, and removing the source would remove the target
+    if isSamePath(srcPath, dstPath):
+        return 'skipped'
     
-    for path in sorted(paths):
-        path = path.replace('\\','/')
-        
-        #print
-        #print 'file_lib.query.path: %s' % path
-        if os.path.isdir(path):
-            temp = sorted(os.listdir(path))
-            files = []
-            for t in temp:
-                p = '%s/%s' % (path, t)
-                files.append(p)
-        else:
-            files = pathToFrames(path)
-        
-        #print 'file_lib.query.files:',files
-        
-        for fPath in files:
-            #print 'file_lib.query.fPath:',fPath
-            #print [os.path.exists(fPath)]
-            
-            if not os.path.exists(fPath):
-                continue
-            
-            #print 'file_lib.qury.go 1'
-            
-            f = os.path.basename(fPath)
-            path = os.path.dirname(fPath)
-            
-            if hideHiddenFiles:
-                if f.startswith('.') or f.endswith('~') or f == 'Thumbs.db':
-                    continue
-            
-            #print 'keyword: %s' % keyword
-            gogo = False
-            if type(keyword) in (str, unicode):
-                if keyword in f:
-                    gogo = True
-            else:
-                if keyword.findall(f):
-                    gogo = True
-            
-            if gogo:
-                try:
-                    mtime = os.path.getmtime(fPath)
-                except:
-                    mtime = 0
-                try:
-                    ctime = os.path.getctime(fPath)
-                except:
-                    ctime = 0
-                
-                # if f is a directory, we take the extension as dir
-                if os.path.isdir(fPath):
-                    ext = '/'
-                else:
-                    ext = os.path.splitext(f)[1][1:]
-                
-                # if filter is empty string, just go forward
-                # else, if extension is in the filter, go forward
-                go = True
-                if exts:
-                    if ext not in exts:
-                        go = False
-                
-                if go:
-                    try:
-                        size = os.path.getsize(fPath)
-                    except:
-                        size = 0
-                    
-                    # do not collect as sequence for directory
-                    if os.path.isdir(fPath) == False and sequence and ext not in unSeqExts:
-                        # try to find the last group of continuous digits
-                        continuousDigitsList = re.findall(pat, f)
-                        #print continuousDigitsList
-                        try:
-                            continuousDigits = re.findall('\d+', continuousDigitsList[-1])[0]
-                            fBaseName = f.split(continuousDigitsList[-1])[0]
-                        except:
-                            continuousDigits = ''
-                            fBaseName = os.path.splitext(f)[0]
-                        
-                        # replace last group of continuousDigits with same number of # as the format
-                        digitStyle = len(continuousDigits)*'#'
-                        format = f[::-1].replace(continuousDigits[::-1], digitStyle, 1)[::-1]
-                    else:
-                        fBaseName = os.path.splitext(f)[0]
-                        continuousDigits = 0
-                        digitStyle = ''
-                        format = f
-                    
-                    key = '%s/%s' % (path, format)
-                    if data.has_key(key) == False:
-                        data[key] = {
-                            'basename': fBaseName,
-                            'directory': path, 
-                            'digits': digitStyle,
-                            'padding': digitStyle,
-                            'extension': ext,
-                            'frames': [],
-                            'missings': [],
-                            'missing': '', 
-                            'filenames': [],
-                            'paths': [],
-                            'real_size': size,
-                            'modified_times': [],
-                            'created_times': [],
-                            }
-                    else:
-                        data[key]['real_size'] += size
-                    
-                    #data[key]['digits'].append(continuousDigits)
-                    if continuousDigits == '':
-                        continuousDigits = 0
-                    else:
-                        continuousDigits = int(continuousDigits)
-                    
-                    data[key]['frames'].append(continuousDigits)
-                    data[key]['filenames'].append(f)
-                    data[key]['paths'].append(fPath)
-                    data[key]['modified_times'].append(mtime)
-                    data[key]['created_times'].append(ctime)
+    if skipSame and isSameFile(srcPath, dstPath, src):
+        if move:
+            os.remove(srcPath)
+        return 'skipped'
     
-    result = []
-    for key in sorted(data.keys()):
-        # Only get files if getAllSubs is True
-        if getAllSubs:
-            if data[key]['extension'] == '/':
-                continue
-        
-        baseName = os.path.basename(key)
-        if data[key]['digits']:
-            data[key]['type'] = 'seq'
-            frames = sorted(data[key]['frames'])
-            data[key]['frame_range'] = framesToFrameRange(frames)
-            data[key]['first_frame'] = frames[0]
-            data[key]['last_frame'] = frames[-1]
-            data[key]['filename'] = baseName
-            data[key]['name'] = baseName
-            data[key]['code'] = baseName
-            data[key]['full_name'] = '%s %s' % (baseName, data[key]['frame_range'])
-            data[key]['path'] = '%s/%s' % (data[key]['directory'], baseName)
-            data[key]['full_path'] = '%s %s' % (data[key]['path'], data[key]['frame_range'])
-            
-            # find missing frames
-            for f in range(frames[0], frames[-1]+1):
-                if f not in frames:
-                    data[key]['missings'].append(f)
-            
-            temp = [str(i) for i in data[key]['missings']]
-            if temp:
-                data[key]['missing'] = '%s Missing: %s' % (len(temp), ','.join(temp))
-        
+    if move:
+        # Renaming is enough in the same filesystem
+        try:
+            if os.name == 'nt' and os.path.exists(dstPath):
+                os.remove(dstPath)
+            os.rename(srcPath, dstPath)
+            return 'moved'
+        except OSError:
+            pass
+    
+    copyFileData(srcPath, dstPath, src)
+    if move:
+        os.remove(srcPath)
+        return 'moved'
+    return 'copied'
+
+def _transferJob(job):
+    srcPath,dstPath,move,skipSame = job
+    return srcPath,dstPath,transferFile(srcPath, dstPath, move=move, skipSame=skipSame)
+
+def transferSequence(srcPath, dstFolder, move=False, workers=4, skipSame=True, callback=None):
+    '''
+    Copies or moves the source path into the target folder.
+    The srcPath can be a normal path or a file sequence path:
+        /abc/abc00101_lgt_pre_v001.####.tga 101-300
+    The frames are transferred by a pool of workers, frames which are
+    already the same in the target folder are skipped, so a broken
+    transfer can be resumed by running it again.
+        callback: called in the caller's thread after each frame is done,
+            callback(done, total, srcPath, dstPath, status)
+    Returns a list of (srcPath, dstPath, status) in the order of the frames,
+    see transferFile for the status.
+    '''
+    if not os.path.isdir(dstFolder):
+        os.makedirs(dstFolder)
+    
+    jobs = []
+    for path in pathToFrames(srcPath):
+        dstPath = '%s/%s' % (dstFolder.replace('\\','/'), os.path.basename(path))
+        jobs.append((path, dstPath, move, skipSame))
+    
+    pool = ThreadPool(min(workers, len(jobs))) if workers > 1 and len(jobs) > 1 else None
+    try:
+        if pool:
+            done = pool.imap_unordered(_transferJob, jobs)
         else:
-            if data[key]['extension'] == '/':
-                data[key]['type'] = 'dir'
-            else:
-                data[key]['type'] = 'single'
-            
-            data[key]['frame_range'] = ''
-            data[key]['first_frame'] = 1
-            data[key]['last_frame'] = 1
-            data[key]['name'] = baseName
-            data[key]['full_name'] = data[key]['name']
-            data[key]['path'] = '%s/%s' % (data[key]['directory'], baseName)
-            data[key]['full_path'] = data[key]['path']
-        
-        data[key]['size'] = getHumanReadableSize(data[key]['real_size'])
-        
-        latestMTime = sorted(data[key]['modified_times'])[-1]
-        data[key]['modified_time'] = secondTimeToString(latestMTime)
+            done = (_transferJob(job) for job in jobs)
         
-        latestCTime = sorted(data[key]['created_times'])[-1]
-        data[key]['created_time'] = secondTimeToString(latestCTime)
-        
-        result.append(data[key])
+        statuses = {}
+        for i,(path,dstPath,status) in enumerate(done):
+            statuses[path] = status
+            if callback:
+                callback(i+1, len(jobs), path, dstPath, status)
     
-    return result
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    
+    return [(job[0], job[1], statuses[job[0]]) for job in jobs]
 
-def copy(srcPath, dstFolder):
+def copy(srcPath, dstFolder, workers=4, callback=None):
     '''
     Copies the source path into the target folder.
     The srcPath can be a normal path or a file sequence path:
         /abc/abc00101_lgt_pre_v001.####.tga
+    See transferSequence for the arguments.
+    '''
+    return transferSequence(srcPath, dstFolder, workers=workers, callback=callback)
+
+def move(srcPath, dstFolder, workers=4, callback=None):
+    '''
+    Moves the source path into the target folder.
+    See transferSequence for the arguments.
     '''
-    files = pathToFrames(srcPath)
-    for path in files:
-        #print 'path:',[path]
-        #print 'exists:',[os.path.exists(path)]
-        if os.path.exists(path):
-            filename = os.path.basename(path)
-            dstPath = os.path.join(dstFolder, filename)
-            #print '%s -> %s' % (path, dstPath)
-            shutil.copyfile(path, dstPath)
+    return transferSequence(srcPath, dstFolder, move=True, workers=workers, callback=callback)
 
 def copyFile(srcPath, dstPath):
     shutil.copyfile(srcPath, dstPath)
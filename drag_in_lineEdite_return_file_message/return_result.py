@@ -37,7 +37,7 @@ class window(QtGui.QWidget):
 
     def analysisfile(self):
         path = self.edit.text()
-        result = fllb.query(path)
+        result = fllb.query(path, useCache=True)
         for i in range(len(result)):
             self.text.setText(str(result[i])+'\n')
         # self.text.setText(str(result))
@@ -0,0 +1,612 @@
+# -*- coding: utf-8 -*-
+'''
+Behavioral tests of actions.py with a stub engine and database.
+
+plcr, rdlb and filterFiles are studio modules, when they are not
+installed a stub module is used, it only has what the tests need.
+
+Run in the root folder of the repository:
+    python -m unittest discover tests
+'''
+import sys
+import os
+import json
+import time
+import types
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubAction(object):
+    '''Same interface as plcr.Action which is used by actions.py.'''
+
+    _defaultParms = {}
+
+    def __init__(self, engine, name='', parms=None, subs=None):
+        self._engine = engine
+        self.name = name
+        self._parms = dict(self._defaultParms)
+        self._parms.update(parms or {})
+        self._subs = subs or []
+        self._formatKeys = {}
+
+    def engine(self):
+        return self._engine
+
+    def subs(self):
+        return self._subs
+
+    def setFormatKeys(self, keys):
+        self._formatKeys.update(keys or {})
+
+    def parm(self, key):
+        value = self._parms.get(key)
+        if isinstance(value, str):
+            keys = dict(self._engine.values)
+            keys.update(self._formatKeys)
+            try:
+                value = value.format(**keys)
+            except (KeyError, IndexError):
+                pass
+        return value
+
+    def database(self):
+        return self._engine.database
+
+    def software(self):
+        return None
+
+
+def _installStubs():
+    try:
+        import plcr
+    except ImportError:
+        plcr = types.ModuleType('plcr')
+        plcr.Action = StubAction
+        plcr.getPublishedFiles = lambda **kwargs: []
+        plcr._localSettingsPath = lambda: tempfile.gettempdir()
+        sys.modules['plcr'] = plcr
+
+    for name in ('rdlb', 'filterFiles'):
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = types.ModuleType(name)
+
+_installStubs()
+
+import plcr
+import actions
+
+
+class StubEngine(object):
+    '''Keeps the results of the actions by their names, like the plcr engine.'''
+
+    def __init__(self, database=None):
+        self.values = {}
+        self.database = database
+        self._lock = threading.Lock()
+
+    def runAction(self, action):
+        r = action.run()
+        with self._lock:
+            self.values[action.name] = r
+        return r
+
+    def setActionValue(self, name, value):
+        self.values[name] = value
+
+
+class StubDatabase(object):
+    '''Records the calls, find returns the filters it's given.'''
+
+    def __init__(self):
+        self.calls = []
+        self.active = 0
+        self.maxActive = 0
+        self._lock = threading.Lock()
+
+    def _call(self, name, *args):
+        with self._lock:
+            self.calls.append((name,) + args)
+            self.active += 1
+            self.maxActive = max(self.maxActive, self.active)
+        time.sleep(0.01)
+        with self._lock:
+            self.active -= 1
+
+    def find(self, project, filters):
+        self._call('find', project)
+        return [{'project': project, 'filters': filters}]
+
+    def getTaskStatus(self, project, id_):
+        self._call('getTaskStatus', project, id_)
+        return 'wip'
+
+    def createVersion(self, project, info):
+        self._call('createVersion', project)
+
+
+class Echo(actions.Action):
+    '''Returns its input, records the thread it runs in.'''
+
+    mainThread = False
+    _defaultParms = {
+        'input': '',
+        'delay': 0.0,
+    }
+
+    def run(self):
+        time.sleep(self.parm('delay'))
+        log = self._formatKeys.get('log')
+        if log is not None:
+            log.append((self.name, threading.current_thread().name))
+        return self.parm('input')
+
+
+class HostEcho(Echo):
+    '''Same as Echo, but must stay on the main thread.'''
+
+    mainThread = True
+
+
+class AppendParm(actions.Action):
+    '''Changes its own parm in place, then returns a copy of it.'''
+
+    mainThread = False
+    _defaultParms = {
+        'items': [],
+    }
+
+    def run(self):
+        items = self._parms['items']
+        items.append(self._formatKeys.get('item'))
+        return list(items)
+
+
+class WaitFor(actions.Action):
+    '''Sets its own event, then waits for the event of another action.'''
+
+    mainThread = False
+    _defaultParms = {}
+
+    def run(self):
+        self._formatKeys['mine'].set()
+        return self._formatKeys['other'].wait(5) or False
+
+
+class SceneProbe(actions.Action):
+    '''Gets the scene inventory which the action sees.'''
+
+    mainThread = False
+
+    def run(self):
+        engine = self.engine()
+        return (actions.isSceneInventoryOpen(engine),
+                actions.getSceneInventory(engine, None))
+
+
+class Fail(actions.Action):
+
+    mainThread = False
+
+    def run(self):
+        raise ValueError('failed')
+
+
+class ForLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = StubEngine()
+        self.log = []
+
+    def loop(self, subs, inputs, **parms):
+        parms['input'] = [{'value': v, 'log': self.log} for v in inputs]
+        return actions.ForLoop(self.engine, name='loop', parms=parms, subs=subs)
+
+    def threadsOf(self, name):
+        return set([t for n,t in self.log if n == name])
+
+    def testSerialKeepsOrder(self):
+        sub = Echo(self.engine, name='echo', parms={'input': '{value}'})
+        r = self.loop([sub], ['a', 'b', 'c']).run()
+        self.assertEqual(r, ['a', 'b', 'c'])
+        self.assertEqual(self.threadsOf('echo'), set([threading.current_thread().name]))
+
+    def testParallelKeepsOrder(self):
+        sub = Echo(self.engine, name='echo', parms={'input': '{value}', 'delay': 0.02})
+        inputs = ['a', 'b', 'c', 'd', 'e', 'f']
+        r = self.loop([sub], inputs, parallel=True, max_workers=3).run()
+        self.assertEqual(r, inputs)
+        self.assertTrue(len(self.threadsOf('echo')) > 1)
+        self.assertFalse(threading.current_thread().name in self.threadsOf('echo'))
+
+    def testParallelItemsRunOnClones(self):
+        sub = AppendParm(self.engine, name='append')
+        inputs = [{'item': i} for i in range(4)]
+        loop = actions.ForLoop(self.engine, name='loop', subs=[sub],
+                               parms={'input': inputs, 'parallel': True, 'max_workers': 4})
+        r = loop.run()
+        self.assertEqual(r, [[0], [1], [2], [3]])
+        self.assertEqual(sub._parms['items'], [])
+        self.assertEqual(sub._formatKeys, {})
+
+    def testSubsReferringToEachOtherRunSerially(self):
+        first = Echo(self.engine, name='first', parms={'input': '{value}'})
+        second = Echo(self.engine, name='second', parms={'input': '{first}!'})
+        r = self.loop([first, second], ['a', 'b', 'c'], parallel=True).run()
+        self.assertEqual(r, ['a!', 'b!', 'c!'])
+        self.assertEqual(self.threadsOf('second'), set([threading.current_thread().name]))
+
+    def testMainThreadSubsRunSerially(self):
+        sub = HostEcho(self.engine, name='host', parms={'input': '{value}'})
+        r = self.loop([sub], ['a', 'b', 'c'], parallel=True).run()
+        self.assertEqual(r, ['a', 'b', 'c'])
+        self.assertEqual(self.threadsOf('host'), set([threading.current_thread().name]))
+
+    def testUnknownParallelMode(self):
+        sub = Echo(self.engine, name='echo')
+        self.assertRaises(Exception, self.loop([sub], ['a'], parallel='process').run)
+
+
+class ActionGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = StubEngine()
+        self.log = []
+
+    def echo(self, name, value, cls=Echo):
+        action = cls(self.engine, name=name, parms={'input': value})
+        action.setFormatKeys({'log': self.log})
+        return action
+
+    def testDependencies(self):
+        a = self.echo('a', 'x')
+        b = self.echo('b', '{a}')
+        c = self.echo('c', 'y')
+        h1 = self.echo('h1', '', cls=HostEcho)
+        h2 = self.echo('h2', '', cls=HostEcho)
+        graph = actions.ActionGraph([a, b, c, h1, h2])
+        self.assertEqual(graph.deps, [set(), set([0]), set(), set(), set([3])])
+
+    def testIndependentActionsRunTogether(self):
+        e1,e2 = threading.Event(),threading.Event()
+        a = WaitFor(self.engine, name='a')
+        a.setFormatKeys({'mine': e1, 'other': e2})
+        b = WaitFor(self.engine, name='b')
+        b.setFormatKeys({'mine': e2, 'other': e1})
+        self.assertEqual(actions.ActionGraph([a, b]).run(self.engine, maxWorkers=2), [True, True])
+
+    def testResultsAndMainThread(self):
+        items = [
+            self.echo('h1', 'one', cls=HostEcho),
+            self.echo('a', 'two'),
+            self.echo('b', '{a}-{h1}'),
+            self.echo('h2', '{b}', cls=HostEcho),
+        ]
+        r = actions.ActionGraph(items).run(self.engine, maxWorkers=4)
+        self.assertEqual(r, ['one', 'two', 'two-one', 'two-one'])
+
+        main = threading.current_thread().name
+        order = [n for n,t in self.log if t == main]
+        self.assertEqual([n for n in order if n.startswith('h')], ['h1', 'h2'])
+
+    def testErrorIsRaised(self):
+        items = [Fail(self.engine, name='fail'), self.echo('b', '{fail}')]
+        graph = actions.ActionGraph(items)
+        self.assertRaises(ValueError, graph.run, self.engine, maxWorkers=2)
+        self.assertFalse(self.engine.values.has_key('b'))
+
+    def testCriticalPath(self):
+        items = [self.echo('a', ''), self.echo('b', '{a}'), self.echo('c', '')]
+        r = actions.ActionGraph(items).criticalPath(estimates={'a': 2, 'b': 3, 'c': 4})
+        self.assertEqual(r['critical_path'], ['a', 'b'])
+        self.assertEqual(r['wall_time'], 5.0)
+        self.assertEqual(r['serial_time'], 9.0)
+
+    def testScheduleSharesSceneInventory(self):
+        subs = [SceneProbe(self.engine, name='p1'), SceneProbe(self.engine, name='p2')]
+        schedule = actions.Schedule(self.engine, name='schedule', subs=subs)
+        (open1,inv1),(open2,inv2) = schedule.run()
+        self.assertTrue(open1 and open2)
+        self.assertTrue(inv1 is inv2)
+        self.assertFalse(actions.isSceneInventoryOpen(self.engine))
+
+
+class GetAssemblyElementsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = StubDatabase()
+        self.engine = StubEngine(self.database)
+        self._getPublishedFiles = plcr.getPublishedFiles
+        plcr.getPublishedFiles = self.getPublishedFiles
+
+    def tearDown(self):
+        plcr.getPublishedFiles = self._getPublishedFiles
+
+    def getPublishedFiles(self, **kwargs):
+        return kwargs['database'].find(kwargs['project'], [kwargs['steps']])
+
+    def action(self, maxWorkers):
+        return actions.GetAssemblyElements(self.engine, name='elements',
+                                           parms={'max_workers': maxWorkers})
+
+    def queries(self):
+        return [
+            {'database': self.database, 'project': 'tst', 'steps': 'rig'},
+            {'database': self.database, 'project': 'tst', 'steps': 'mod'},
+            {'database': self.database, 'project': 'tst', 'steps': 'rig'},
+            {'database': self.database, 'project': 'tst', 'steps': 'ani'},
+        ]
+
+    def testSameQueriesRunOnce(self):
+        r = self.action(1).getPublishedFiles(self.queries())
+        self.assertEqual(len(self.database.calls), 3)
+        self.assertEqual([i[0]['filters'] for i in r], [['rig'], ['mod'], ['rig'], ['ani']])
+        self.assertEqual(r[0], r[2])
+        self.assertFalse(r[0] is r[2])
+
+    def testThreadsCallDatabaseOneAtATime(self):
+        r = self.action(4).getPublishedFiles(self.queries())
+        self.assertEqual([i[0]['filters'] for i in r], [['rig'], ['mod'], ['rig'], ['ani']])
+        self.assertEqual(len(self.database.calls), 3)
+        self.assertEqual(self.database.maxActive, 1)
+
+
+class VersionIndexTest(unittest.TestCase):
+
+    pattern = 'tst_lgt_v###.ma'
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.listings = 0
+        self._listdir = os.listdir
+        def listdir(path):
+            self.listings += 1
+            return self._listdir(path)
+        os.listdir = listdir
+
+    def tearDown(self):
+        os.listdir = self._listdir
+        shutil.rmtree(self.folder)
+
+    def touch(self, *versions):
+        for v in versions:
+            open('%s/tst_lgt_v%03d.ma' % (self.folder, v), 'w').close()
+
+    def latest(self):
+        return actions.getLatestVersionInFolder(self.folder, self.pattern)
+
+    def indexPath(self):
+        return '%s/%s' % (self.folder, actions._versionIndexFilename)
+
+    def testLookupDoesNotWriteIndex(self):
+        self.touch(1, 2)
+        self.assertEqual(self.latest()['latest_file'], 'tst_lgt_v002.ma')
+        self.assertFalse(os.path.exists(self.indexPath()))
+
+    def testRecordedVersionIsUsed(self):
+        self.touch(1, 2, 3)
+        actions.recordVersion(self.folder, self.pattern, 3, 'tst_lgt_v003.ma')
+        mtime = os.stat(self.folder).st_mtime
+        if mtime == int(mtime):
+            self.skipTest('the file system keeps the time in seconds')
+
+        r = self.latest()
+        self.assertEqual(self.listings, 0)
+        self.assertEqual(r['latest_file'], 'tst_lgt_v003.ma')
+        self.assertEqual(r['current_file'], 'tst_lgt_v004.ma')
+
+    def testChangedFolderIsListed(self):
+        self.touch(1)
+        actions.recordVersion(self.folder, self.pattern, 1, 'tst_lgt_v001.ma')
+        self.touch(2)
+        os.utime(self.folder, (time.time() + 5,)*2)
+        self.assertEqual(self.latest()['latest_file'], 'tst_lgt_v002.ma')
+        self.assertEqual(self.listings, 1)
+
+    def testRacyIndexIsListed(self):
+        # Whole seconds, like a file system keeping the time in seconds
+        mtime = int(time.time())
+        self.touch(1)
+        os.utime(self.folder, (mtime, mtime))
+        actions.recordVersion(self.folder, self.pattern, 1, 'tst_lgt_v001.ma')
+
+        # A skipped version number written in the same second
+        self.touch(3)
+        os.utime(self.folder, (mtime, mtime))
+        self.assertEqual(self.latest()['latest_file'], 'tst_lgt_v003.ma')
+        self.assertEqual(self.listings, 1)
+
+    def testWithoutIndex(self):
+        self.touch(1, 2)
+        r = actions.getLatestVersionInFolder(self.folder, self.pattern, useIndex=False)
+        self.assertEqual(r['latest_version'], 'v002')
+        self.assertEqual(self.listings, 1)
+
+
+class FileHashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        folder = self.folder
+
+        class Cache(actions._FileHashCache):
+            def path(self):
+                return '%s/file_hashes.json' % folder
+
+        self.Cache = Cache
+        self._cache = actions._fileHashCache
+        actions._fileHashCache = Cache()
+
+    def tearDown(self):
+        actions._fileHashCache = self._cache
+        shutil.rmtree(self.folder)
+
+    def write(self, name, data, age=10):
+        path = '%s/%s' % (self.folder, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        # Whole seconds, utime may not keep the fraction
+        t = int(time.time() - age)
+        os.utime(path, (t, t))
+        return path
+
+    def testHashIsReused(self):
+        path = self.write('a.tif', 'abc')
+        digest = actions.getFileHash(path)
+        self.assertEqual(digest, '900150983cd24fb0d6963f7d28e17f72')
+
+        # Same size and time, the cached hash is returned
+        t = os.stat(path).st_mtime
+        self.write('a.tif', 'xyz')
+        os.utime(path, (t, t))
+        self.assertEqual(actions.getFileHash(path), digest)
+        self.assertNotEqual(actions.getFileHash(path, useCache=False), digest)
+
+    def testChangedFileIsHashedAgain(self):
+        path = self.write('a.tif', 'abc')
+        digest = actions.getFileHash(path)
+        self.write('a.tif', 'abcd', age=20)
+        self.assertNotEqual(actions.getFileHash(path), digest)
+
+    def testNewFileIsNotCached(self):
+        path = self.write('a.tif', 'abc', age=-1)
+        actions.getFileHash(path)
+        self.assertFalse(actions._fileHashCache._dirty)
+
+    def testNotAFile(self):
+        self.assertEqual(actions.getFileHash(self.folder), None)
+        self.assertEqual(actions.getFileHash('%s/missing' % self.folder), None)
+
+    def testSaveMergesAndPrunes(self):
+        first = self.Cache(maxSize=2)
+        second = self.Cache(maxSize=2)
+        first.set('a', [1], 'da')
+        first.save()
+        time.sleep(0.01)
+        second.set('b', [1], 'db')
+        second.save()
+        time.sleep(0.01)
+        first.set('c', [1], 'dc')
+        first.save()
+
+        data = json.load(open(first.path()))
+        self.assertEqual(sorted(data.keys()), ['b', 'c'])
+        self.assertEqual(self.Cache().get('b', [1]), 'db')
+        self.assertEqual(self.Cache().get('b', [2]), None)
+
+
+class CachedDatabaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = StubDatabase()
+        self.cached = actions.CachedDatabase(self.database)
+
+    def testCachedMethod(self):
+        r1 = self.cached.find('tst', [['code', '=', 'a']])
+        r1[0]['project'] = 'changed'
+        r2 = self.cached.find('tst', [['code', '=', 'a']])
+        self.cached.find('tst', [['code', '=', 'b']])
+        self.assertEqual(r2[0]['project'], 'tst')
+        self.assertEqual(len(self.database.calls), 2)
+
+        stats = self.cached.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+
+    def testReadMethodIsNotCached(self):
+        self.cached.getTaskStatus('tst', 1)
+        self.cached.getTaskStatus('tst', 1)
+        self.assertEqual(len(self.database.calls), 2)
+        self.assertEqual(self.cached.stats()['invalidations'], 0)
+
+    def testWriteClearsCache(self):
+        self.cached.find('tst', [])
+        self.cached.createVersion('tst', {})
+        self.cached.find('tst', [])
+        self.assertEqual([c[0] for c in self.database.calls], ['find', 'createVersion', 'find'])
+        self.assertEqual(self.cached.stats()['invalidations'], 1)
+
+    def testExpiredResult(self):
+        self.cached.ttl = 0
+        self.cached.find('tst', [])
+        self.cached.find('tst', [])
+        self.assertEqual(len(self.database.calls), 2)
+
+    def testEngineCacheIsOptIn(self):
+        engine = StubEngine(self.database)
+        self.assertTrue(actions.getCachedDatabase(engine, self.database) is self.database)
+
+        actions.DatabaseCache(engine, name='cache').run()
+        proxy = actions.getCachedDatabase(engine, self.database)
+        self.assertTrue(isinstance(proxy, actions.CachedDatabase))
+        self.assertTrue(actions.getCachedDatabase(engine, self.database) is proxy)
+
+        # Running it again drops the results of the last run
+        actions.DatabaseCache(engine, name='cache').run()
+        self.assertFalse(actions.getCachedDatabase(engine, self.database) is proxy)
+
+
+class StubSoftware(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def getReferenceObjects(self):
+        self.calls += 1
+        return [{'namespace': 'dog1', 'path': 'dog.ma'}]
+
+    def getGpuCaches(self):
+        return []
+
+    def getAssemblyReferences(self):
+        return []
+
+
+class SceneInventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = StubEngine()
+        self.software = StubSoftware()
+
+    def inventory(self):
+        return actions.getSceneInventory(self.engine, self.software)
+
+    def testNotSharedOutOfSceneRun(self):
+        self.inventory().getReferenceObjects()
+        self.inventory().getReferenceObjects()
+        self.assertEqual(self.software.calls, 2)
+
+    def testSharedInSceneRun(self):
+        actions.beginSceneInventory(self.engine)
+        self.assertTrue(self.inventory() is self.inventory())
+        self.inventory().getReferenceObjects()
+        self.assertEqual(self.inventory().getNamespaces(), ['dog1'])
+        self.assertEqual(self.software.calls, 1)
+
+        actions.endSceneInventory(self.engine)
+        self.inventory().getReferenceObjects()
+        self.assertEqual(self.software.calls, 2)
+
+    def testInvalidate(self):
+        actions.beginSceneInventory(self.engine)
+        inventory = self.inventory()
+        actions.invalidateSceneInventory(self.engine)
+        self.assertFalse(self.inventory() is inventory)
+        self.assertTrue(actions.isSceneInventoryOpen(self.engine))
+        actions.endSceneInventory(self.engine)
+
+    def testResultsAreCopies(self):
+        actions.beginSceneInventory(self.engine)
+        self.inventory().getReferenceObjects().append({})
+        self.assertEqual(len(self.inventory().getReferenceObjects()), 1)
+        actions.endSceneInventory(self.engine)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,24 @@
 import os
 import os.path
+import sys
+import re
+import json
+import stat
 import shutil
+import hashlib
 import time,  datetime
+from multiprocessing.pool import ThreadPool
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# Files are copied and hashed in chunks of this size
+chunkSize = 1024 * 1024
 
 def copyFiles(sourceDir,  targetDir):
   if sourceDir.find(".svn") > 0:
@@ -13,10 +30,183 @@ def copyFiles(sourceDir,  targetDir):
       if not os.path.exists(targetDir):  
         os.makedirs(targetDir)
       if not os.path.exists(targetFile) or(os.path.exists(targetFile) and (os.path.getsize(targetFile) != os.path.getsize(sourceFile))):
-        open(targetFile, "wb").write(open(sourceFile, "rb").read())
-      if os.path.isdir(sourceFile):
-        First_Directory = False
-        copyFiles(sourceFile, targetFile)
+        copyFileChunked(sourceFile, targetFile)
+    if os.path.isdir(sourceFile):
+      copyFiles(sourceFile, targetFile)
+
+
+def scanTree(rootDir):
+  '''
+  Walks the rootDir recursively, .svn folders are skipped.
+  Returns {relative path: (size, mtime)} of the files, paths use "/".
+  '''
+  result = {}
+  if not os.path.isdir(rootDir):
+    return result
+  stack = ['']
+  while stack:
+    relDir = stack.pop()
+    curDir = os.path.join(rootDir, relDir)
+    if scandir:
+      items = [(e.name, e.stat(follow_symlinks=False)) for e in scandir(curDir)]
+    else:
+      items = [(name, os.lstat(os.path.join(curDir, name))) for name in os.listdir(curDir)]
+    for name, st in items:
+      relPath = relDir + '/' + name if relDir else name
+      if stat.S_ISDIR(st.st_mode):
+        if name != '.svn':
+          stack.append(relPath)
+      elif stat.S_ISREG(st.st_mode):
+        result[relPath] = (st.st_size, st.st_mtime)
+  return result
+
+
+def getFileHash(path):
+  md5 = hashlib.md5()
+  f = open(path, "rb")
+  try:
+    for chunk in iter(lambda: f.read(chunkSize), b''):
+      md5.update(chunk)
+  finally:
+    f.close()
+  return md5.hexdigest()
+
+
+def isSameFile(sourceFile, targetFile, sourceInfo, targetInfo, useHash=False):
+  '''
+  Files with different sizes are different.
+  With useHash the contents are compared, otherwise the modified times,
+  in seconds since some filesystems drop the rest.
+  '''
+  if sourceInfo[0] != targetInfo[0]:
+    return False
+  if useHash:
+    return getFileHash(sourceFile) == getFileHash(targetFile)
+  return int(sourceInfo[1]) == int(targetInfo[1])
+
+
+def copyFileChunked(sourceFile, targetFile):
+  '''
+  Copies the file in chunks to a temp file beside the target,
+  then renames it to the target, the modified time is kept.
+  '''
+  targetDir = os.path.dirname(targetFile)
+  if targetDir and not os.path.exists(targetDir):
+    try:
+      os.makedirs(targetDir)
+    except OSError:
+      if not os.path.isdir(targetDir):
+        raise
+  tempFile = targetFile + '.tmp'
+  fsrc = open(sourceFile, "rb")
+  try:
+    fdst = open(tempFile, "wb")
+    try:
+      shutil.copyfileobj(fsrc, fdst, chunkSize)
+    finally:
+      fdst.close()
+  finally:
+    fsrc.close()
+  st = os.stat(sourceFile)
+  os.utime(tempFile, (st.st_atime, st.st_mtime))
+  if os.name == 'nt' and os.path.exists(targetFile):
+    os.remove(targetFile)
+  os.rename(tempFile, targetFile)
+
+
+# Frame number of a sequence file name, like img.0001.exr
+framePattern = re.compile(r'\.(\d+)(\.[^./\\]+)$')
+
+
+def groupSequences(paths):
+  '''
+  Groups the paths of frame sequences to keep the manifest short:
+    ['a/img.0001.exr', 'a/img.0002.exr', 'a/img.0004.exr'] -> ['a/img.####.exr 1-2,4']
+  Only the files in the same folder with a frame number before the extension are grouped.
+  '''
+  groups = {}
+  for path in paths:
+    find = framePattern.search(path)
+    if find:
+      key = path[:find.start(1)] + '#' * len(find.group(1)) + find.group(2)
+      frame = int(find.group(1))
+    else:
+      key, frame = path, None
+    groups.setdefault(key, []).append((frame, path))
+  result = []
+  for key in sorted(groups):
+    items = sorted(groups[key])
+    if len(items) == 1:
+      result.append(items[0][1])
+      continue
+    ranges = []
+    for frame, path in items:
+      if ranges and frame == ranges[-1][1] + 1:
+        ranges[-1][1] = frame
+      else:
+        ranges.append([frame, frame])
+    frameRange = ','.join([str(a) if a == b else '%s-%s' % (a, b) for a, b in ranges])
+    result.append('%s %s' % (key, frameRange))
+  return result
+
+
+def mirrorFiles(sourceDir, targetDir, workers=4, useHash=False, delete=False, manifestFile=None):
+  '''
+  Makes targetDir the same as sourceDir, only the changed files are copied.
+  Files are compared by size and modified time, or by contents with useHash.
+  With delete, the files not in sourceDir are removed from targetDir.
+  Returns the manifest of the changes, it's saved as json if manifestFile is given:
+    {'added': [...], 'updated': [...], 'deleted': [...], 'unchanged': 120, ...}
+  '''
+  startTime = time.time()
+  sourceFiles = scanTree(sourceDir)
+  targetFiles = scanTree(targetDir)
+
+  def compare(relPath):
+    if relPath not in targetFiles:
+      return relPath, 'added'
+    sourceFile = os.path.join(sourceDir, relPath)
+    targetFile = os.path.join(targetDir, relPath)
+    if isSameFile(sourceFile, targetFile, sourceFiles[relPath], targetFiles[relPath], useHash):
+      return relPath, 'unchanged'
+    return relPath, 'updated'
+
+  def copy(relPath):
+    copyFileChunked(os.path.join(sourceDir, relPath), os.path.join(targetDir, relPath))
+
+  pool = ThreadPool(max(1, workers))
+  try:
+    states = dict(pool.map(compare, sorted(sourceFiles)))
+    changed = [p for p in sorted(states) if states[p] != 'unchanged']
+    pool.map(copy, changed)
+  finally:
+    pool.close()
+    pool.join()
+
+  deleted = []
+  if delete:
+    deleted = sorted([p for p in targetFiles if p not in sourceFiles])
+    for relPath in deleted:
+      os.remove(os.path.join(targetDir, relPath))
+
+  manifest = {
+    'source': sourceDir,
+    'target': targetDir,
+    'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    'seconds': round(time.time() - startTime, 3),
+    'added': groupSequences([p for p in changed if states[p] == 'added']),
+    'updated': groupSequences([p for p in changed if states[p] == 'updated']),
+    'deleted': groupSequences(deleted),
+    'unchanged': len(states) - len(changed),
+    'copied_bytes': sum([sourceFiles[p][0] for p in changed]),
+  }
+  if manifestFile:
+    f = open(manifestFile, "w")
+    try:
+      json.dump(manifest, f, indent=2, sort_keys=True)
+    finally:
+      f.close()
+  return manifest
 
 
 def removeFileInFirstDir(targetDir):
@@ -31,7 +221,7 @@ def coverFiles(sourceDir,  targetDir):
         sourceFile = os.path.join(sourceDir,  file) 
         targetFile = os.path.join(targetDir,  file)
         if os.path.isfile(sourceFile):
-          open(targetFile, "wb").write(open(sourceFile, "rb").read())
+          copyFileChunked(sourceFile, targetFile)
 def moveFileto(sourceDir,  targetDir):
   
   shutil.copy(sourceDir,  targetDir)
@@ -49,7 +239,12 @@ def getCurTime():
   if len(day) < 2:
     day = '0' + day
   return (year + '-' + month + '-' + day)
-if  __name__ =="__main__":
+if  __name__ =="__main__" and len(sys.argv) > 2:
+  # copyFile.py sourceDir targetDir [manifest.json]
+  manifestFile = sys.argv[3] if len(sys.argv) > 3 else None
+  manifest = mirrorFiles(sys.argv[1], sys.argv[2], manifestFile=manifestFile)
+  print "added: %s, updated: %s, unchanged: %s" % (len(manifest['added']), len(manifest['updated']), manifest['unchanged'])
+elif  __name__ =="__main__":
   print "Start(S) or Quilt(Q) \n"
   flag = True
   while (flag):